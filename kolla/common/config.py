@@ -94,12 +94,30 @@ _CLI_OPTS = [
                        ))),
     cfg.BoolOpt('push', default=False,
                 help='Push images after building'),
-    cfg.IntOpt('push-threads', default=1, min=1,
-               help=('The number of threads to user while pushing'
-                     ' Images. Note: Docker can not handle threading'
-                     ' push properly')),
+    cfg.IntOpt('push-threads', default=4, min=1,
+               help=('The number of threads to use while pushing'
+                     ' images. Images are always pushed after their'
+                     ' parent, so independent images are pushed in'
+                     ' parallel')),
+    cfg.IntOpt('registry-push-threads', min=1,
+               help=('The maximum number of images pushed to a single'
+                     ' registry at the same time. By default only'
+                     ' push-threads limits it')),
+    cfg.IntOpt('fetch-threads', default=4, min=1,
+               help=('The number of threads to use while fetching the'
+                     ' sources of images ahead of their build')),
     cfg.IntOpt('retries', short='r', default=3, min=0,
                help='The number of times to retry while building'),
+    cfg.BoolOpt('resume', default=False,
+                help=('Resume the build recorded in --work-dir, only images'
+                      ' that were not built or pushed yet are processed')),
+    cfg.IntOpt('retry-budget', min=0,
+               help=('The number of retries allowed for the whole build,'
+                     ' unlimited by default. Deterministic failures are'
+                     ' never retried')),
+    cfg.FloatOpt('retry-backoff', default=2, min=0,
+                 help=('Base delay in seconds before retrying a failed task,'
+                       ' doubled on every retry and randomized')),
     cfg.MultiOpt('regex', types.String(), positional=True,
                  help=('Build only images matching regex and its'
                        ' dependencies')),
@@ -118,8 +136,31 @@ _CLI_OPTS = [
                help='The method of the ceph install'),
     cfg.IntOpt('threads', short='T', default=8, min=1,
                help=('The number of threads to use while building.'
-                     ' (Note: setting to one will allow real time'
-                     ' logging)')),
+                     ' Logs of all threads are written in real time by a'
+                     ' dedicated writer thread')),
+    cfg.MultiOpt('docker-host', types.String(), default=[],
+                 help=('Docker host to build on, e.g. tcp://host:2376. Can'
+                       ' be specified multiple times to spread the build'
+                       ' over several hosts, each building up to --threads'
+                       ' images. Defaults to the host of the environment')),
+    cfg.StrOpt('docker-host-transfer', default='save',
+               choices=['save', 'registry'],
+               help=('How images built on one Docker host are copied to'
+                     ' the host building their children. "registry"'
+                     ' pulls them once pushed and needs --push')),
+    cfg.IntOpt('docker-pool-size', min=1,
+               help=('The number of idle Docker API clients kept open for'
+                     ' reuse by build and push tasks. Defaults to the sum'
+                     ' of threads and push-threads plus one, 13 with the'
+                     ' default numbers of threads')),
+    cfg.BoolOpt('adaptive-threads', default=False,
+                help=('Adapt the number of concurrent builds to the load'
+                      ' average, Docker API latency, free disk of the'
+                      ' Docker root and build throughput, in between'
+                      ' --min-threads and --threads')),
+    cfg.IntOpt('min-threads', default=1, min=1,
+               help=('The minimum number of concurrent builds with'
+                     ' --adaptive-threads')),
     cfg.StrOpt('tag',
                help='The Docker tag'),
     cfg.BoolOpt('template-only', default=False,
@@ -133,14 +174,49 @@ _CLI_OPTS = [
                        ' can be specified multiple times'),
                  short='D', default=[]),
     cfg.StrOpt('logs-dir', help='Path to logs directory'),
+    cfg.StrOpt('log-format', default='text', choices=['text', 'json'],
+               help=('Format of the build logs of images. "json" writes'
+                     ' one JSON object per line')),
+    cfg.IntOpt('log-buffer-lines', default=1000, min=0,
+               help=('The number of the most recent log lines kept in'
+                     ' memory for every image, shown again in the summary'
+                     ' when the image fails')),
     cfg.BoolOpt('pull', default=True,
                 help='Attempt to pull a newer version of the base image'),
     cfg.StrOpt('work-dir', help=('Path to be used as working directory.'
                                  ' By default, a temporary dir is created')),
+    cfg.StrOpt('source-cache-dir',
+               help=('Path to keep git mirrors and archives of image'
+                     ' sources in between runs. Defaults to'
+                     ' "source-cache" in the working directory when'
+                     ' --work-dir is set')),
+    cfg.StrOpt('cache-import',
+               help=('Layer cache to seed the Docker cache with before'
+                     ' building. Either a directory written by'
+                     ' --cache-export, whose images are loaded, or a JSON'
+                     ' manifest listing previously built images to pull')),
+    cfg.StrOpt('cache-export',
+               help=('Directory to save the images built in this run to,'
+                     ' as a layer cache for --cache-import')),
+    cfg.StrOpt('metrics-file',
+               help=('Path to write build metrics to in the Prometheus text'
+                     ' format while building, e.g. for the textfile'
+                     ' collector of the node exporter')),
+    cfg.PortOpt('metrics-port',
+                help=('Port to serve build metrics on in the Prometheus'
+                      ' text format at /metrics while building')),
+    cfg.StrOpt('history-file',
+               help=('Path to the JSON file recording per image build'
+                     ' durations across runs. Defaults to'
+                     ' "build-history.json" in the working directory when'
+                     ' --work-dir is set')),
     cfg.BoolOpt('squash', default=False,
                 help=('Squash the image layers. WARNING: it will consume lots'
                       ' of disk IO. "docker-squash" tool is required, install'
                       ' it by "pip install docker-squash"')),
+    cfg.IntOpt('squash-threads', default=1, min=1,
+               help=('The number of threads to use while squashing images.'
+                     ' Squashing does not hold build threads')),
 ]
 
 _BASE_OPTS = [
@@ -208,7 +284,9 @@ def get_source_opts(type_=None, location=None, reference=None):
                        help='The location for source install'),
             cfg.StrOpt('reference', default=reference,
                        help=('Git reference to pull, commit sha, tag '
-                             'or branch name'))]
+                             'or branch name')),
+            cfg.StrOpt('sha256',
+                       help='Expected SHA256 checksum of a url source')]
 
 
 def get_user_opts(uid, gid):
@@ -20,6 +20,8 @@ class Task(object):
 
     def __init__(self):
         self.success = False
+        # Classification of the last failure, see kolla.image.retry.
+        self.failure = None
 
     @abc.abstractproperty
     def name(self):
@@ -27,6 +29,10 @@ class Task(object):
 
     def reset(self):
         self.success = False
+        self.failure = None
+
+    def release(self):
+        """Give back resources held while the task was running."""
 
     @property
     def followups(self):
@@ -10,10 +10,173 @@
 # See the License for the specific language governing permissions and
 # limitations under the License.
 
+import atexit
+import collections
+import datetime
+import json
 import logging
 import os
 import subprocess  # nosec
 import sys
+import tarfile
+import threading
+
+import six
+
+
+# Number of log lines kept in memory per image when not configured.
+LOG_BUFFER_LINES = 1000
+
+# Maximum number of log lines the writer thread writes in one go.
+LOG_WRITE_BATCH = 512
+
+
+class LogWriter(threading.Thread):
+    """Thread writing the log lines of all images in batches.
+
+    Build threads only format records and hand them over, so that they
+    never wait on disk or on the terminal. Log files are opened on the
+    first line written to them and kept open.
+    """
+
+    _instance = None
+    _instance_lock = threading.Lock()
+
+    def __init__(self):
+        super(LogWriter, self).__init__(name='LogWriter')
+        self.daemon = True
+        self.queue = six.moves.queue.Queue()
+        self.files = dict()
+
+    @classmethod
+    def instance(cls):
+        with cls._instance_lock:
+            if cls._instance is None:
+                cls._instance = cls()
+                cls._instance.start()
+                atexit.register(cls._instance.flush)
+            return cls._instance
+
+    def write(self, target, line):
+        """Queue a line for a file path, or for stderr if target is None."""
+        self.queue.put((target, line))
+
+    def flush(self):
+        """Block until every queued line is written."""
+        self.queue.join()
+
+    def run(self):
+        while True:
+            batch = [self.queue.get()]
+            while len(batch) < LOG_WRITE_BATCH:
+                try:
+                    batch.append(self.queue.get_nowait())
+                except six.moves.queue.Empty:
+                    break
+            lines = collections.OrderedDict()
+            for target, line in batch:
+                lines.setdefault(target, []).append(line)
+            for target, target_lines in lines.items():
+                try:
+                    self._write(target, ''.join(target_lines))
+                except Exception as e:
+                    sys.stderr.write('Unable to write logs to %s: %s\n' %
+                                     (target, e))
+            for _ in batch:
+                self.queue.task_done()
+
+    def _write(self, target, data):
+        if target is None:
+            stream = sys.stderr
+        else:
+            stream = self.files.get(target)
+            if stream is None:
+                stream = self.files[target] = open(target, 'a')
+        stream.write(data)
+        stream.flush()
+
+
+class JSONFormatter(logging.Formatter):
+    """Format records as JSON objects, one per line."""
+
+    def format(self, record):
+        entry = {
+            'time': datetime.datetime.utcfromtimestamp(
+                record.created).isoformat() + 'Z',
+            'level': record.levelname,
+            'logger': record.name,
+            'message': record.getMessage(),
+        }
+        if record.exc_info:
+            entry['exception'] = self.formatException(record.exc_info)
+        return json.dumps(entry, sort_keys=True)
+
+
+class ImageLogHandler(logging.Handler):
+    """Handler of the logger of an image.
+
+    Records are formatted in the calling thread and written by the
+    LogWriter thread, to the log file of the image or to stderr. The last
+    records are also kept in memory, to be shown again when the image
+    fails to build.
+    """
+
+    def __init__(self, filename=None, buffer_lines=LOG_BUFFER_LINES):
+        super(ImageLogHandler, self).__init__()
+        self.filename = filename
+        self.buffer = collections.deque(maxlen=buffer_lines)
+        # Number of lines emitted so far, including the ones no longer
+        # kept in the buffer.
+        self.emitted = 0
+
+    def emit(self, record):
+        try:
+            line = self.format(record)
+        except Exception:
+            self.handleError(record)
+            return
+        self.buffer.append(line)
+        self.emitted += 1
+        LogWriter.instance().write(self.filename, line + '\n')
+
+
+def _get_image_log_handler(logger):
+    for handler in logger.handlers:
+        if isinstance(handler, ImageLogHandler):
+            return handler
+    return None
+
+
+def get_log_position(logger):
+    """Return the number of lines logged so far by an image logger."""
+    handler = _get_image_log_handler(logger)
+    if handler is None:
+        return 0
+    with handler.lock:
+        return handler.emitted
+
+
+def get_log_buffer(logger, since=None):
+    """Return the log lines kept in memory for an image logger.
+
+    :param since: position returned by get_log_position, only the lines
+                  logged after it are returned
+    """
+    handler = _get_image_log_handler(logger)
+    if handler is None:
+        return []
+    with handler.lock:
+        lines = list(handler.buffer)
+        if since is not None:
+            lines = lines[len(lines) - min(len(lines),
+                                           handler.emitted - since):]
+    return lines
+
+
+def flush_logs():
+    """Wait until the logs of every image are written."""
+    if LogWriter._instance is not None:
+        LogWriter._instance.flush()
 
 
 def make_a_logger(conf=None, image_name=None):
@@ -22,13 +185,28 @@ def make_a_logger(conf=None, image_name=None):
     else:
         log = logging.getLogger(__name__)
     if not log.handlers:
-        if conf is None or not conf.logs_dir or not image_name:
+        if not image_name:
             handler = logging.StreamHandler(sys.stderr)
             log.propagate = False
+            handler.setFormatter(logging.Formatter(logging.BASIC_FORMAT))
         else:
-            filename = os.path.join(conf.logs_dir, "%s.log" % image_name)
-            handler = logging.FileHandler(filename, delay=True)
-        handler.setFormatter(logging.Formatter(logging.BASIC_FORMAT))
+            filename = None
+            buffer_lines = LOG_BUFFER_LINES
+            log_format = 'text'
+            if conf is not None:
+                if conf.logs_dir:
+                    filename = os.path.join(conf.logs_dir,
+                                            "%s.log" % image_name)
+                buffer_lines = conf.log_buffer_lines
+                log_format = conf.log_format
+            if filename is None:
+                log.propagate = False
+            handler = ImageLogHandler(filename, buffer_lines)
+            if log_format == 'json':
+                handler.setFormatter(JSONFormatter())
+            else:
+                handler.setFormatter(
+                    logging.Formatter(logging.BASIC_FORMAT))
         log.addHandler(handler)
     if conf is not None and conf.debug:
         log.setLevel(logging.DEBUG)
@@ -56,7 +234,8 @@ def get_docker_squash_version():
 def squash(old_image, new_image,
            from_layer=None,
            cleanup=False,
-           tmp_dir=None):
+           tmp_dir=None,
+           docker_host=None):
 
     cmds = ['docker-squash', '--tag', new_image, old_image]
     if cleanup:
@@ -65,9 +244,103 @@ def squash(old_image, new_image,
         cmds += ['--from-layer', from_layer]
     if tmp_dir:
         cmds += ['--tmp-dir', tmp_dir]
+    env = None
+    if docker_host:
+        env = dict(os.environ, DOCKER_HOST=docker_host)
     try:
-        subprocess.check_output(cmds, stderr=subprocess.STDOUT)  # nosec
+        subprocess.check_output(cmds, stderr=subprocess.STDOUT,  # nosec
+                                env=env)
     except subprocess.CalledProcessError as ex:
         LOG.exception('Get error during squashing image: %s',
                       ex.output)
         raise
+
+
+def normalize_tarinfo(info):
+    """Strip the host specific metadata of a tar member.
+
+    Ownership is set to root, modes to 0755 for directories and executable
+    files and 0644 for other files, and every timestamp to 0, so that
+    identical trees always give identical archives.
+    """
+    info.uid = info.gid = 0
+    info.uname = info.gname = ''
+    info.mtime = 0
+    if info.isdir() or (info.isreg() and info.mode & 0o111):
+        info.mode = 0o755
+    elif not info.issym():
+        info.mode = 0o644
+    for key in ('mtime', 'atime', 'ctime', 'uid', 'gid', 'uname', 'gname'):
+        info.pax_headers.pop(key, None)
+    return info
+
+
+def open_tar(name=None, fileobj=None):
+    """Open a tar archive for writing in a reproducible format."""
+    return tarfile.open(name, mode='w', fileobj=fileobj,
+                        format=tarfile.PAX_FORMAT)
+
+
+def add_to_tar(tar, path, arcname, exclude=()):
+    """Add a file or directory tree to a tar archive reproducibly.
+
+    Directory entries are added in sorted order and every member is
+    normalized with normalize_tarinfo.
+
+    :param exclude: names of files and directories left out at any depth
+                    of the tree
+    """
+    info = tar.gettarinfo(path, arcname=arcname)
+    if info is None:
+        # sockets and other unsupported file types
+        return
+    normalize_tarinfo(info)
+    if info.isreg():
+        with open(path, 'rb') as f:
+            tar.addfile(info, f)
+    else:
+        tar.addfile(info)
+    if info.isdir():
+        for name in sorted(os.listdir(path)):
+            if name in exclude:
+                continue
+            add_to_tar(tar, os.path.join(path, name), arcname + '/' + name,
+                       exclude)
+
+
+def merge_archives(archives, dest, arcname):
+    """Merge tar archives into a single archive under a top directory.
+
+    Members are copied straight from the input tar streams into the output
+    archive, nothing is extracted to disk. Inputs are merged in the given
+    order and every member is normalized with normalize_tarinfo.
+
+    :param archives: paths of the tar archives to merge, in any compression
+                     supported by tarfile
+    :param dest: path of the resulting uncompressed archive
+    :param arcname: name of the top directory in the resulting archive
+    :return: the number of distinct top level entries merged
+    """
+    top_level = set()
+    with open_tar(dest) as out:
+        root = tarfile.TarInfo(arcname)
+        root.type = tarfile.DIRTYPE
+        out.addfile(normalize_tarinfo(root))
+        for archive in archives:
+            with tarfile.open(archive, 'r|*') as tar:
+                for member in tar:
+                    name = os.path.normpath(member.name).lstrip('/')
+                    if name in ('.', '..') or name.startswith('../'):
+                        continue
+                    top_level.add(name.split('/')[0])
+                    member.name = '%s/%s' % (arcname, name)
+                    if member.islnk():
+                        member.linkname = '%s/%s' % (
+                            arcname, os.path.normpath(member.linkname))
+                    normalize_tarinfo(member)
+                    fileobj = None
+                    if member.isreg():
+                        fileobj = tar.extractfile(member)
+                    out.addfile(member, fileobj)
+    os.utime(dest, (0, 0))
+    return len(top_level)
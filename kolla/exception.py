@@ -27,3 +27,7 @@ class KollaMismatchBaseTypeException(Exception):
 
 class KollaRpmSetupUnknownConfig(Exception):
     pass
+
+
+class KollaImageTransferException(Exception):
+    pass
@@ -14,15 +14,18 @@
 
 from __future__ import print_function
 
+import collections
 import contextlib
 import datetime
-import errno
+import hashlib
+import heapq
+import itertools
 import json
 import logging
 import os
 import re
-import requests
 import shutil
+import stat
 import sys
 import tarfile
 import tempfile
@@ -32,7 +35,6 @@ import time
 from distutils.version import LooseVersion
 from distutils.version import StrictVersion
 import docker
-import git
 import jinja2
 from oslo_config import cfg
 from requests import exceptions as requests_exc
@@ -51,6 +53,13 @@ from kolla.common import config as common_config  # noqa
 from kolla.common import task  # noqa
 from kolla.common import utils  # noqa
 from kolla import exception  # noqa
+from kolla.image import cache as layer_cache  # noqa
+from kolla.image import concurrency  # noqa
+from kolla.image import history as build_history  # noqa
+from kolla.image import metrics as build_metrics  # noqa
+from kolla.image import retry  # noqa
+from kolla.image import state as build_state  # noqa
+from kolla.image import sources  # noqa
 from kolla.template import filters as jinja_filters  # noqa
 from kolla.template import methods as jinja_methods  # noqa
 from kolla import version  # noqa
@@ -84,6 +93,16 @@ STATUS_ERRORS = (STATUS_CONNECTION_ERROR, STATUS_PUSH_ERROR,
 UNBUILDABLE_IMAGES = {
 }
 
+# Label holding the fingerprint of the inputs an image was built from.
+FINGERPRINT_LABEL = 'kolla_build_fingerprint'
+
+# Matches the FROM line naming the parent of an image.
+PARENT_SEARCH_PATTERN = re.compile(br'^FROM[ \t]+\S+', re.MULTILINE)
+
+# Warn in the summary when an image took this many times longer to build
+# than its recorded average.
+BUILD_REGRESSION_FACTOR = 1.5
+
 
 class ArchivingError(Exception):
     pass
@@ -110,9 +129,169 @@ def join_many(threads):
             LOG.warning('Force exits')
 
 
+class TaskTracker(object):
+    """Tracks the unfinished tasks of several queues.
+
+    Workers report finished tasks through the tracker, which wakes up
+    whoever waits for all queues to drain right away.
+    """
+
+    def __init__(self, *queues):
+        self.queues = queues
+        self.condition = threading.Condition()
+
+    def task_done(self, queue):
+        queue.task_done()
+        with self.condition:
+            self.condition.notify_all()
+
+    def has_unfinished_tasks(self):
+        return any(queue.unfinished_tasks for queue in self.queues)
+
+    def wait(self):
+        """Block until every task of every queue is done."""
+        with self.condition:
+            while self.has_unfinished_tasks():
+                # NOTE: Python 2 never delivers KeyboardInterrupt to a wait
+                #       without timeout, see join_many.
+                self.condition.wait(0xffff)
+
+
+class PriorityTaskQueue(six.moves.queue.PriorityQueue):
+    """Queue that hands out the most urgent task first.
+
+    Tasks are ordered by their ``priority`` attribute, highest first. Tasks
+    with the same priority are handed out in the order they were added.
+    Objects without a priority (like the worker tombstone) count as 0.
+    """
+
+    def _init(self, maxsize):
+        six.moves.queue.PriorityQueue._init(self, maxsize)
+        self._counter = itertools.count()
+
+    def _put(self, item):
+        priority = getattr(item, 'priority', 0)
+        heapq.heappush(self.queue, (-priority, next(self._counter), item))
+
+    def _get(self):
+        return heapq.heappop(self.queue)[-1]
+
+
+class HostTaskQueues(object):
+    """Build queues of the Docker hosts a build is spread over.
+
+    Every host has its own PriorityTaskQueue served by its own workers, so
+    that workers waiting for a build slot of a busy host never hold back
+    the ready images of another host. Tasks are put into the queue of
+    their ``docker_host``.
+    """
+
+    def __init__(self, hosts):
+        self.queues = collections.OrderedDict(
+            (host, PriorityTaskQueue()) for host in hosts or [None])
+
+    def put(self, task):
+        if task is WorkerThread.tombstone:
+            for queue in self.queues.values():
+                queue.put(task)
+            return
+        queue = self.queues.get(getattr(task, 'docker_host', None))
+        if queue is None:
+            queue = next(iter(self.queues.values()))
+        queue.put(task)
+
+    def qsize(self):
+        return sum(queue.qsize() for queue in self.queues.values())
+
+    @property
+    def unfinished_tasks(self):
+        return sum(queue.unfinished_tasks for queue in self.queues.values())
+
+
+class HashingReader(object):
+    """File wrapper feeding all the data read through it into a hash."""
+
+    def __init__(self, fileobj, sha):
+        self.fileobj = fileobj
+        self.sha = sha
+
+    def read(self, size=-1):
+        data = self.fileobj.read(size)
+        self.sha.update(data)
+        return data
+
+
+class DockerClientPool(object):
+    """Thread-safe pool of Docker API clients shared by the whole process.
+
+    The API version is negotiated by the first client only, later clients
+    are created with that explicit version. Released clients are kept
+    open, so that their HTTP connections are reused by the next task.
+    Acquiring never blocks: when every pooled client is in use a new one
+    is created, and at most ``size`` idle clients are kept around.
+    """
+
+    _instances = dict()
+    _instance_lock = threading.Lock()
+
+    def __init__(self, size, **docker_kwargs):
+        self.size = size
+        self.docker_kwargs = docker_kwargs
+        self.version = None
+        self._idle = []
+        self._lock = threading.Lock()
+
+    @classmethod
+    def instance(cls, size=None, base_url=None):
+        """Return the process-wide pool of a Docker host.
+
+        The pool is created on first use. ``base_url`` defaults to the host
+        configured in the environment.
+        """
+        with cls._instance_lock:
+            pool = cls._instances.get(base_url)
+            if pool is None:
+                docker_kwargs = docker.utils.kwargs_from_env()
+                if base_url:
+                    docker_kwargs['base_url'] = base_url
+                pool = cls._instances[base_url] = cls(size or 1,
+                                                      **docker_kwargs)
+            elif size and size > pool.size:
+                pool.size = size
+            return pool
+
+    def _create(self):
+        if self.version is None:
+            client = docker.APIClient(version='auto', **self.docker_kwargs)
+            self.version = client.api_version
+            LOG.debug('Negotiated Docker API version %s', self.version)
+        else:
+            client = docker.APIClient(version=self.version,
+                                      **self.docker_kwargs)
+        return client
+
+    def acquire(self):
+        with self._lock:
+            if self._idle:
+                return self._idle.pop()
+            # NOTE: Negotiate the version under the lock, so that it is
+            #       only done once when many threads start at the same time.
+            if self.version is None:
+                return self._create()
+        return self._create()
+
+    def release(self, client):
+        with self._lock:
+            if len(self._idle) < self.size:
+                self._idle.append(client)
+                return
+        client.close()
+
+
 class DockerTask(task.Task):
 
-    docker_kwargs = docker.utils.kwargs_from_env()
+    #: Docker host the task talks to, None for the one of the environment.
+    docker_host = None
 
     def __init__(self):
         super(DockerTask, self).__init__()
@@ -122,15 +301,202 @@ class DockerTask(task.Task):
     def dc(self):
         if self._dc is not None:
             return self._dc
-        docker_kwargs = self.docker_kwargs.copy()
-        self._dc = docker.APIClient(version='auto', **docker_kwargs)
+        self._dc = DockerClientPool.instance(
+            base_url=self.docker_host).acquire()
         return self._dc
 
+    def release(self):
+        if self._dc is not None:
+            DockerClientPool.instance(
+                base_url=self.docker_host).release(self._dc)
+            self._dc = None
+
+    def record_built(self, image, state):
+        """Record a finished image and its ID in the state of the build."""
+        if state is None:
+            return
+        try:
+            image_id = self.dc.inspect_image(image.canonical_name)['Id']
+        except Exception as e:
+            image.logger.warning('Unable to record the ID of the image: %s',
+                                 e)
+            return
+        state.record(image, image_id)
+
+
+class DockerHosts(object):
+    """Docker hosts a build is spread over, see --docker-host.
+
+    Every host builds at most --threads images at the same time, or the
+    number chosen by the ConcurrencyController with --adaptive-threads.
+    Images built on one host are copied to another one before their
+    children are built there, either with docker save and load or, when
+    images are pushed, by pulling them from the registry.
+    """
+
+    def __init__(self, conf, hosts, pool_size=None):
+        self.conf = conf
+        self.hosts = list(hosts)
+        slot_hosts = self.hosts
+        if not slot_hosts and conf.adaptive_threads:
+            slot_hosts = [None]
+        self.slots = dict(
+            (host, concurrency.ResizableSemaphore(conf.threads))
+            for host in slot_hosts)
+        self._lock = threading.Lock()
+        self._transfer_locks = dict()
+        self._transferred = set()
+        for host in self.hosts:
+            DockerClientPool.instance(pool_size, base_url=host)
+
+    @contextlib.contextmanager
+    def slot(self, host):
+        """Hold one of the build slots of a host."""
+        semaphore = self.slots.get(host)
+        if semaphore is None:
+            yield
+            return
+        with semaphore:
+            yield
+
+    def ensure_image(self, image, host, push_scheduler, logger):
+        """Make sure the current version of an image is on a host.
+
+        Images built in this run are copied from the host that built them
+        when their ID differs on the target host. Other images are only
+        copied when the target host does not have them at all, and are
+        left for the target host to pull when no host has them.
+        """
+        if image.docker_host == host:
+            return
+        key = (image.canonical_name, host)
+        with self._lock:
+            lock = self._transfer_locks.setdefault(key, threading.Lock())
+        with lock:
+            if key in self._transferred:
+                return
+            sources = ([image.docker_host] if image.docker_host else
+                       [h for h in self.hosts if h != host])
+            target_pool = DockerClientPool.instance(base_url=host)
+            target = target_pool.acquire()
+            try:
+                try:
+                    target_id = target.inspect_image(
+                        image.canonical_name)['Id']
+                except docker.errors.NotFound:
+                    target_id = None
+                if ((target_id is None or image.docker_host) and
+                        not self._transfer(image, sources, host, target,
+                                           target_id, push_scheduler,
+                                           logger)):
+                    if image.docker_host:
+                        raise exception.KollaImageTransferException(
+                            'Image %s is not available on %s' %
+                            (image.canonical_name, image.docker_host))
+                    self._pull(image, host, target, logger)
+            finally:
+                target_pool.release(target)
+            self._transferred.add(key)
+
+    def _transfer(self, image, sources, host, target, target_id,
+                  push_scheduler, logger):
+        """Copy an image to a host from the first source that has it.
+
+        :return: False when none of the sources has the image
+        """
+        for source_host in sources:
+            source_pool = DockerClientPool.instance(base_url=source_host)
+            source = source_pool.acquire()
+            try:
+                try:
+                    source_id = source.inspect_image(
+                        image.canonical_name)['Id']
+                except docker.errors.NotFound:
+                    continue
+                if source_id == target_id:
+                    return True
+                if (self.conf.docker_host_transfer == 'registry' and
+                        self.conf.push):
+                    push_scheduler.wait_pushed(image)
+                    logger.info('Pulling %s on %s', image.canonical_name,
+                                host)
+                    repository, tag = image.canonical_name.rsplit(':', 1)
+                    responses = target.pull(repository, tag=tag,
+                                            stream=True, decode=True)
+                else:
+                    logger.info('Copying %s from %s to %s',
+                                image.canonical_name, source_host, host)
+                    responses = target.load_image(
+                        source.get_image(image.canonical_name))
+                self._check_responses(image, host, responses)
+                return True
+            finally:
+                source_pool.release(source)
+        return False
+
+    def _pull(self, image, host, target, logger):
+        """Let a host get an image no Docker host of the build has.
+
+        The image is pulled right away with --pull, otherwise the Docker
+        daemon of the host pulls it when building the first child.
+        """
+        if not self.conf.pull:
+            logger.info('%s is not on any Docker host, leaving it to %s '
+                        'to pull', image.canonical_name, host)
+            return
+        logger.info('Pulling %s on %s', image.canonical_name, host)
+        repository, tag = image.canonical_name.rsplit(':', 1)
+        self._check_responses(image, host, target.pull(
+            repository, tag=tag, stream=True, decode=True))
+
+    @staticmethod
+    def _check_responses(image, host, responses):
+        for response in responses or []:
+            if 'errorDetail' in response:
+                raise exception.KollaImageTransferException(
+                    'Unable to get %s on %s: %s' % (
+                        image.canonical_name, host,
+                        response['errorDetail']['message']))
+
+
+class DockerImageIndex(object):
+    """Tags and IDs of the images present in the local Docker cache.
+
+    The index is loaded with a single API call the first time it is
+    queried and then shared by every image of a build.
+    """
+
+    def __init__(self, docker_client):
+        self.dc = docker_client
+        self._tags = None
+        self._ids = None
+        self._lock = threading.Lock()
+
+    def load(self):
+        tags = set()
+        ids = set()
+        for image in self.dc.images():
+            ids.add(image['Id'])
+            for tag in image.get('RepoTags') or []:
+                if tag != '<none>:<none>':
+                    tags.add(tag)
+        self._tags = tags
+        self._ids = ids
+        LOG.debug('Indexed %d local images with %d tags', len(ids),
+                  len(tags))
+
+    def __contains__(self, name):
+        with self._lock:
+            if self._tags is None:
+                self.load()
+        return name in self._tags or name in self._ids
+
 
 class Image(object):
     def __init__(self, name, canonical_name, path, parent_name='',
                  status=STATUS_UNPROCESSED, parent=None,
-                 source=None, logger=None, docker_client=None):
+                 source=None, logger=None, docker_client=None,
+                 image_index=None):
         self.name = name
         self.canonical_name = canonical_name
         self.path = path
@@ -145,11 +511,38 @@ class Image(object):
         self.plugins = []
         self.additions = []
         self.dc = docker_client
+        self.image_index = image_index
+        # Estimated cost of building this image alone and of the longest
+        # chain of matched descendants starting at it (see
+        # KollaWorker.prioritize_images).
+        self.weight = 1
+        self.critical_path = 0
+        # Duration in seconds of each build phase, see
+        # kolla.image.history.PHASES.
+        self.timings = dict()
+        self.cache_hits = 0
+        self.build_steps = 0
+        self.fingerprint = None
+        # Whether an existing image with the same fingerprint was tagged
+        # instead of building it again.
+        self.reused = False
+        # Digest of the pushed manifest and layer statistics of the push.
+        self.push_digest = None
+        self.push_stats = dict()
+        # Images imported from a layer cache to use as build cache.
+        self.cache_from = []
+        self.squash_bytes_saved = None
+        # Size of the build context sent to Docker.
+        self.context_size = 0
+        # Docker host building the image, None for the one of the
+        # environment.
+        self.docker_host = None
 
     def copy(self):
         c = Image(self.name, self.canonical_name, self.path,
                   logger=self.logger, parent_name=self.parent_name,
-                  status=self.status, parent=self.parent)
+                  status=self.status, parent=self.parent,
+                  docker_client=self.dc, image_index=self.image_index)
         if self.source:
             c.source = self.source.copy()
         if self.children:
@@ -160,7 +553,24 @@ class Image(object):
             c.additions = list(self.additions)
         return c
 
+    @contextlib.contextmanager
+    def timed(self, phase):
+        """Record how long the wrapped block takes as a build phase."""
+        start = time.time()
+        try:
+            yield
+        finally:
+            self.timings[phase] = time.time() - start
+
+    @property
+    def cache_hit_ratio(self):
+        if not self.build_steps:
+            return None
+        return float(self.cache_hits) / self.build_steps
+
     def in_docker_cache(self):
+        if self.image_index is not None:
+            return self.canonical_name in self.image_index
         return len(self.dc.images(name=self.canonical_name, quiet=True)) == 1
 
     def __repr__(self):
@@ -170,6 +580,85 @@ class Image(object):
             self.parent_name, self.status, self.parent, self.source)
 
 
+class PushScheduler(object):
+    """Coordinates the pushes of a build.
+
+    Images are pushed after their parent, so that the layers they share
+    are uploaded once and found in the registry by the child push. The
+    number of concurrent pushes to a single registry is bounded by
+    --registry-push-threads. Layer statistics are collected across all
+    pushes, so that layers skipped by a child push can be accounted with
+    the bytes uploaded by its parent.
+    """
+
+    def __init__(self, conf):
+        self.conf = conf
+        self._lock = threading.Lock()
+        self._pushed = dict()
+        self._semaphores = dict()
+        self._layer_sizes = dict()
+
+    def expect(self, image):
+        """Register an image whose push is about to be queued."""
+        with self._lock:
+            self._pushed.setdefault(image.canonical_name, threading.Event())
+
+    def done(self, image):
+        with self._lock:
+            event = self._pushed.get(image.canonical_name)
+        if event is not None:
+            event.set()
+
+    def wait_for_parent(self, image):
+        """Block until the push of the parent of an image has finished.
+
+        Parents are queued for push before their children are built, so
+        the parent push is always running or done when this is called.
+        """
+        if image.parent is not None:
+            self.wait_pushed(image.parent, image.logger)
+
+    def wait_pushed(self, image, logger=None):
+        """Block until the push of an image has finished, if it is pushed."""
+        with self._lock:
+            event = self._pushed.get(image.canonical_name)
+        if event is not None and not event.is_set():
+            (logger or image.logger).info('Waiting for the push of image %s',
+                                          image.name)
+            event.wait()
+
+    @staticmethod
+    def get_registry(canonical_name):
+        first = canonical_name.split('/', 1)[0]
+        if ('/' in canonical_name and
+                ('.' in first or ':' in first or first == 'localhost')):
+            return first
+        return 'docker.io'
+
+    @contextlib.contextmanager
+    def registry_slot(self, image):
+        limit = self.conf.registry_push_threads
+        if not limit:
+            yield
+            return
+        registry = self.get_registry(image.canonical_name)
+        with self._lock:
+            semaphore = self._semaphores.get(registry)
+            if semaphore is None:
+                semaphore = threading.Semaphore(limit)
+                self._semaphores[registry] = semaphore
+        with semaphore:
+            yield
+
+    def record_layer(self, layer_id, size):
+        with self._lock:
+            self._layer_sizes[layer_id] = size
+
+    def layer_size(self, layer_id):
+        with self._lock:
+            return self._layer_sizes.get(layer_id, 0)
+
+
 class PushIntoQueueTask(task.Task):
     """Task that pushes some other task into a queue."""
 
@@ -191,11 +680,17 @@ class PushIntoQueueTask(task.Task):
 class PushTask(DockerTask):
     """Task that pushes an image to a docker repository."""
 
-    def __init__(self, conf, image):
+    def __init__(self, conf, image, scheduler=None, state=None):
         super(PushTask, self).__init__()
         self.conf = conf
         self.image = image
+        self.docker_host = image.docker_host
         self.logger = image.logger
+        if scheduler is None:
+            scheduler = PushScheduler(conf)
+        self.scheduler = scheduler
+        self.state = state
+        self.attempted = False
 
     @property
     def name(self):
@@ -203,25 +698,70 @@ class PushTask(DockerTask):
 
     def run(self):
         image = self.image
+        if self.attempted and image.status in STATUS_ERRORS:
+            # NOTE: The image was built, only pushing it is retried.
+            image.status = STATUS_BUILT
+        self.attempted = True
+        self.scheduler.wait_for_parent(image)
         self.logger.info('Trying to push the image')
         try:
-            self.push_image(image)
+            with self.scheduler.registry_slot(image):
+                with image.timed('push'):
+                    if self.is_pushed(image):
+                        self.logger.info('Image %s is already in the'
+                                         ' registry', image.canonical_name)
+                        image.push_stats['skipped'] = True
+                    else:
+                        self.push_image(image)
         except requests_exc.ConnectionError:
             self.logger.exception('Make sure Docker is running and that you'
                                   ' have the correct privileges to run Docker'
                                   ' (root)')
             image.status = STATUS_CONNECTION_ERROR
-        except Exception:
+            self.failure = retry.TRANSIENT
+        except Exception as e:
             self.logger.exception('Unknown error when pushing')
             image.status = STATUS_PUSH_ERROR
+            self.failure = retry.classify_exception(e)
         finally:
             if (image.status not in STATUS_ERRORS
                     and image.status != STATUS_UNPROCESSED):
                 self.logger.info('Pushed successfully')
                 self.success = True
+                if self.state is not None:
+                    self.state.record(image)
             else:
                 self.success = False
 
+    def reset(self):
+        super(PushTask, self).reset()
+        self.image.push_stats = dict()
+
+    def release(self):
+        super(PushTask, self).release()
+        # NOTE: Retries happen before release, so children waiting for this
+        #       push are only woken up once it is final.
+        self.scheduler.done(self.image)
+
+    def is_pushed(self, image):
+        """Whether the registry already has the manifest of the image."""
+        try:
+            descriptor = self.dc.inspect_distribution(image.canonical_name)
+            repo_digests = self.dc.inspect_image(
+                image.canonical_name).get('RepoDigests') or []
+        except Exception as e:
+            # NOTE: Either the tag is not in the registry or the registry
+            #       or Docker do not support the query, push in both cases.
+            self.logger.debug('Unable to look up %s in the registry: %s',
+                              image.canonical_name, e)
+            return False
+        digest = descriptor.get('Descriptor', {}).get('digest')
+        repository = image.canonical_name.rsplit(':', 1)[0]
+        if digest and '%s@%s' % (repository, digest) in repo_digests:
+            image.push_digest = digest
+            return True
+        return False
+
     def push_image(self, image):
         kwargs = dict(stream=True, decode=True)
 
@@ -231,122 +771,160 @@ class PushTask(DockerTask):
         if dc_running_ver < StrictVersion('3.0.0'):
             kwargs['insecure_registry'] = True
 
+        layer_sizes = dict()
+        pushed = set()
+        skipped = set()
         for response in self.dc.push(image.canonical_name, **kwargs):
             if 'stream' in response:
                 self.logger.info(response['stream'])
             elif 'errorDetail' in response:
-                image.status = STATUS_ERROR
+                image.status = STATUS_PUSH_ERROR
                 self.logger.error(response['errorDetail']['message'])
+                self.failure = retry.classify_messages(
+                    [response['errorDetail']['message']])
+            elif 'aux' in response:
+                image.push_digest = response['aux'].get('Digest')
+            elif 'id' in response:
+                layer_id = response['id']
+                status = response.get('status', '')
+                progress = response.get('progressDetail') or {}
+                if progress.get('total'):
+                    layer_sizes[layer_id] = progress['total']
+                if status == 'Pushed':
+                    pushed.add(layer_id)
+                elif status == 'Layer already exists':
+                    skipped.add(layer_id)
+
+        for layer_id in pushed:
+            self.scheduler.record_layer(layer_id, layer_sizes.get(layer_id, 0))
+        image.push_stats = {
+            'layers_pushed': len(pushed),
+            'layers_skipped': len(skipped),
+            'bytes_pushed': sum(layer_sizes.get(layer_id, 0)
+                                for layer_id in pushed),
+            # NOTE: Registries do not report the size of layers they
+            #       already have, only layers uploaded during this run are
+            #       accounted for.
+            'bytes_skipped': sum(self.scheduler.layer_size(layer_id)
+                                 for layer_id in skipped),
+        }
+        self.logger.info('Pushed %(layers_pushed)d layers'
+                         ' (%(bytes_pushed)d bytes), skipped'
+                         ' %(layers_skipped)d layers already in the registry'
+                         ' (%(bytes_skipped)d bytes known)', image.push_stats)
 
 
 class BuildTask(DockerTask):
     """Task that builds out an image."""
 
-    def __init__(self, conf, image, push_queue):
+    def __init__(self, conf, image, push_queue, fetcher=None,
+                 push_scheduler=None, squash_stage=None, docker_hosts=None,
+                 state=None):
         super(BuildTask, self).__init__()
         self.conf = conf
         self.image = image
+        self.docker_host = image.docker_host
         self.push_queue = push_queue
+        if fetcher is None:
+            fetcher = sources.SourceFetcher(conf)
+        self.fetcher = fetcher
+        if push_scheduler is None:
+            push_scheduler = PushScheduler(conf)
+        self.push_scheduler = push_scheduler
+        if squash_stage is None:
+            squash_stage = SquashStage(conf)
+        self.squash_stage = squash_stage
+        if docker_hosts is None:
+            docker_hosts = DockerHosts(conf, [])
+        self.docker_hosts = docker_hosts
+        self.state = state
         self.nocache = not conf.cache
         self.forcerm = not conf.keep
         self.logger = image.logger
+        # Log position the current attempt started at.
+        self.log_position = None
 
     @property
     def name(self):
         return 'BuildTask(%s)' % self.image.name
 
+    @property
+    def priority(self):
+        return self.image.critical_path
+
     def run(self):
-        self.builder(self.image)
+        self.log_position = utils.get_log_position(self.logger)
+        # NOTE: Copying the parent image does not hold a build slot.
+        if self.ensure_parent(self.image):
+            with self.docker_hosts.slot(self.docker_host):
+                self.builder(self.image)
         if self.image.status in (STATUS_BUILT, STATUS_SKIPPED):
             self.success = True
+            if self.image.status == STATUS_BUILT and not self.conf.squash:
+                self.record_built(self.image, self.state)
+        elif self.image.status == STATUS_PARENT_ERROR:
+            self.failure = retry.DETERMINISTIC
+        elif self.failure is None:
+            self.failure = retry.classify_log(self.logger,
+                                              since=self.log_position)
+
+    def ensure_parent(self, image):
+        """Copy the parent of an image to the Docker host building it."""
+        if (image.parent is None or not self.docker_host or
+                image.status in (STATUS_SKIPPED, STATUS_UNBUILDABLE,
+                                 STATUS_UNMATCHED) or
+                image.parent.status in STATUS_ERRORS):
+            return True
+        try:
+            self.docker_hosts.ensure_image(image.parent, self.docker_host,
+                                           self.push_scheduler, self.logger)
+        except Exception as e:
+            self.logger.exception('Unable to get parent image %s on %s',
+                                  image.parent.name, self.docker_host)
+            image.status = STATUS_ERROR
+            self.failure = retry.classify_exception(e)
+            return False
+        return True
 
     @property
     def followups(self):
+        if (self.success and self.conf.squash and
+                self.image.status == STATUS_BUILT):
+            squash_task = SquashTask(self.conf, self.image, self,
+                                     self.squash_stage)
+            if self.squash_stage.queue is None:
+                return [squash_task]
+            return [PushIntoQueueTask(squash_task, self.squash_stage.queue)]
+        return self.image_followups()
+
+    def image_followups(self):
+        """Tasks to run once the image is ready: its push and children."""
         followups = []
         if self.conf.push and self.success:
+            self.push_scheduler.expect(self.image)
             followups.extend([
                 # If we are supposed to push the image into a docker
                 # repository, then make sure we do that...
                 PushIntoQueueTask(
-                    PushTask(self.conf, self.image),
+                    PushTask(self.conf, self.image, self.push_scheduler,
+                             self.state),
                     self.push_queue),
             ])
         if self.image.children and self.success:
             for image in self.image.children:
                 if image.status == STATUS_UNMATCHED:
                     continue
-                followups.append(BuildTask(self.conf, image, self.push_queue))
+                followups.append(BuildTask(self.conf, image, self.push_queue,
+                                           self.fetcher, self.push_scheduler,
+                                           self.squash_stage,
+                                           self.docker_hosts, self.state))
         return followups
 
     def process_source(self, image, source):
-        dest_archive = os.path.join(image.path, source['name'] + '-archive')
-
-        if source.get('type') == 'url':
-            self.logger.debug("Getting archive from %s", source['source'])
-            try:
-                r = requests.get(source['source'], timeout=self.conf.timeout)
-            except requests_exc.Timeout:
-                self.logger.exception(
-                    'Request timed out while getting archive from %s',
-                    source['source'])
-                image.status = STATUS_ERROR
-                return
-
-            if r.status_code == 200:
-                with open(dest_archive, 'wb') as f:
-                    f.write(r.content)
-            else:
-                self.logger.error(
-                    'Failed to download archive: status_code %s',
-                    r.status_code)
-                image.status = STATUS_ERROR
-                return
-
-        elif source.get('type') == 'git':
-            clone_dir = '{}-{}'.format(dest_archive,
-                                       source['reference'].replace('/', '-'))
-            if os.path.exists(clone_dir):
-                self.logger.info("Clone dir %s exists. Removing it.",
-                                 clone_dir)
-                shutil.rmtree(clone_dir)
-
-            try:
-                self.logger.debug("Cloning from %s", source['source'])
-                git.Git().clone(source['source'], clone_dir)
-                git.Git(clone_dir).checkout(source['reference'])
-                reference_sha = git.Git(clone_dir).rev_parse('HEAD')
-                self.logger.debug("Git checkout by reference %s (%s)",
-                                  source['reference'], reference_sha)
-            except Exception as e:
-                self.logger.error("Failed to get source from git", image.name)
-                self.logger.error("Error: %s", e)
-                # clean-up clone folder to retry
-                shutil.rmtree(clone_dir)
-                image.status = STATUS_ERROR
-                return
-
-            with tarfile.open(dest_archive, 'w') as tar:
-                tar.add(clone_dir, arcname=os.path.basename(clone_dir))
-
-        elif source.get('type') == 'local':
-            self.logger.debug("Getting local archive from %s",
-                              source['source'])
-            if os.path.isdir(source['source']):
-                with tarfile.open(dest_archive, 'w') as tar:
-                    tar.add(source['source'],
-                            arcname=os.path.basename(source['source']))
-            else:
-                shutil.copyfile(source['source'], dest_archive)
-
-        else:
-            self.logger.error("Wrong source type '%s'", source.get('type'))
+        archive = self.fetcher.get_archive(image, source)
+        if archive is None:
             image.status = STATUS_ERROR
-            return
-
-        # Set time on destination archive to epoch 0
-        os.utime(dest_archive, (0, 0))
-
-        return dest_archive
+        return archive
 
     def update_buildargs(self):
         buildargs = dict()
@@ -367,37 +945,21 @@ class BuildTask(DockerTask):
 
     def builder(self, image):
 
-        def make_an_archive(items, arcname, item_child_path=None):
-            if not item_child_path:
-                item_child_path = arcname
+        def make_an_archive(items, arcname):
             archives = list()
-            items_path = os.path.join(image.path, item_child_path)
-            for item in items:
+            for item in sorted(items, key=lambda item: item['name']):
                 archive_path = self.process_source(image, item)
                 if image.status in STATUS_ERRORS:
                     raise ArchivingError
                 archives.append(archive_path)
-            if archives:
-                for archive in archives:
-                    with tarfile.open(archive, 'r') as archive_tar:
-                        archive_tar.extractall(path=items_path)
-            else:
-                try:
-                    os.mkdir(items_path)
-                except OSError as e:
-                    if e.errno == errno.EEXIST:
-                        self.logger.info(
-                            'Directory %s already exist. Skipping.',
-                            items_path)
-                    else:
-                        self.logger.error('Failed to create directory %s: %s',
-                                          items_path, e)
-                        image.status = STATUS_CONNECTION_ERROR
-                        raise ArchivingError
             arc_path = os.path.join(image.path, '%s-archive' % arcname)
-            with tarfile.open(arc_path, 'w') as tar:
-                tar.add(items_path, arcname=arcname)
-            return len(os.listdir(items_path))
+            try:
+                return utils.merge_archives(archives, arc_path, arcname)
+            except (EnvironmentError, tarfile.TarError) as e:
+                self.logger.error('Failed to merge archives into %s: %s',
+                                  arc_path, e)
+                image.status = STATUS_ERROR
+                raise ArchivingError
 
         self.logger.debug('Processing')
 
@@ -419,85 +981,386 @@ class BuildTask(DockerTask):
         image.start = datetime.datetime.now()
         self.logger.info('Building started at %s' % image.start)
 
-        if image.source and 'source' in image.source:
-            self.process_source(image, image.source)
-            if image.status in STATUS_ERRORS:
-                return
+        with image.timed('archive'):
+            if image.source and 'source' in image.source:
+                self.process_source(image, image.source)
+                if image.status in STATUS_ERRORS:
+                    return
 
-        if self.conf.install_type == 'source':
-            try:
-                plugins_am = make_an_archive(image.plugins, 'plugins')
-            except ArchivingError:
-                self.logger.error(
-                    "Failed turning any plugins into a plugins archive")
-                return
-            else:
-                self.logger.debug(
-                    "Turned %s plugins into plugins archive",
-                    plugins_am)
-            try:
-                additions_am = make_an_archive(image.additions, 'additions')
-            except ArchivingError:
-                self.logger.error(
-                    "Failed turning any additions into a additions archive")
-                return
-            else:
-                self.logger.debug(
-                    "Turned %s additions into additions archive",
-                    additions_am)
+            if self.conf.install_type == 'source':
+                try:
+                    plugins_am = make_an_archive(image.plugins, 'plugins')
+                except ArchivingError:
+                    self.logger.error(
+                        "Failed turning any plugins into a plugins archive")
+                    return
+                else:
+                    self.logger.debug(
+                        "Turned %s plugins into plugins archive",
+                        plugins_am)
+                try:
+                    additions_am = make_an_archive(image.additions,
+                                                   'additions')
+                except ArchivingError:
+                    self.logger.error(
+                        "Failed turning any additions into a additions"
+                        " archive")
+                    return
+                else:
+                    self.logger.debug(
+                        "Turned %s additions into additions archive",
+                        additions_am)
 
         # Pull the latest image for the base distro only
         pull = self.conf.pull if image.parent is None else False
 
         buildargs = self.update_buildargs()
+        image.cache_hits = image.build_steps = 0
+        context = None
         try:
-            for stream in self.dc.build(path=image.path,
-                                        tag=image.canonical_name,
-                                        nocache=not self.conf.cache,
-                                        rm=True,
-                                        decode=True,
-                                        network_mode=self.conf.network_mode,
-                                        pull=pull,
-                                        forcerm=self.forcerm,
-                                        buildargs=buildargs):
-                if 'stream' in stream:
-                    for line in stream['stream'].split('\n'):
-                        if line:
-                            self.logger.info('%s', line)
-                if 'errorDetail' in stream:
-                    image.status = STATUS_ERROR
-                    self.logger.error('Error\'d with the following message')
-                    for line in stream['errorDetail']['message'].split('\n'):
-                        if line:
-                            self.logger.error('%s', line)
-                    return
+            with image.timed('context'):
+                context, context_hash = self.make_build_context(image)
+            image.fingerprint = self.fingerprint(image, buildargs,
+                                                 context_hash)
+            # NOTE: Images pulling a newer base must always go through
+            #       Docker, their inputs are not all on the local disk.
+            if self.conf.cache and not pull and self.reuse_image(image):
+                image.status = STATUS_BUILT
+                return
 
-            if image.status != STATUS_ERROR and self.conf.squash:
-                self.squash()
-        except docker.errors.DockerException:
+            with image.timed('build'):
+                for stream in self.dc.build(
+                        fileobj=context,
+                        custom_context=True,
+                        tag=image.canonical_name,
+                        nocache=not self.conf.cache,
+                        rm=True,
+                        decode=True,
+                        network_mode=self.conf.network_mode,
+                        pull=pull,
+                        forcerm=self.forcerm,
+                        buildargs=buildargs,
+                        cache_from=image.cache_from or None,
+                        labels={FINGERPRINT_LABEL: image.fingerprint}):
+                    if 'stream' in stream:
+                        for line in stream['stream'].split('\n'):
+                            if line:
+                                self.logger.info('%s', line)
+                                self.count_step(image, line)
+                    if 'errorDetail' in stream:
+                        image.status = STATUS_ERROR
+                        self.logger.error(
+                            'Error\'d with the following message')
+                        for line in (stream['errorDetail']['message']
+                                     .split('\n')):
+                            if line:
+                                self.logger.error('%s', line)
+                        self.failure = retry.classify_log(
+                            self.logger, [stream['errorDetail']['message']],
+                            since=self.log_position)
+                        return
+        except docker.errors.DockerException as e:
             image.status = STATUS_ERROR
             self.logger.exception('Unknown docker error when building')
-        except Exception:
+            self.failure = retry.classify_exception(e)
+        except Exception as e:
             image.status = STATUS_ERROR
             self.logger.exception('Unknown error when building')
+            self.failure = retry.classify_exception(e)
         else:
             image.status = STATUS_BUILT
             now = datetime.datetime.now()
             self.logger.info('Built at %s (took %s)' %
                              (now, now - image.start))
+        finally:
+            if context is not None:
+                context.close()
+
+    def fingerprint(self, image, buildargs, context_hash):
+        """Hash everything an image is built from.
+
+        This covers the hash of the build context (see
+        make_build_context), the build arguments and the image it is built
+        FROM. The ID of the parent image is used rather than its
+        fingerprint, so that a parent rebuilt on top of a newer base image
+        also changes the fingerprint of its children.
+        """
+        sha = hashlib.sha256()
+        try:
+            parent_id = self.dc.inspect_image(image.parent_name)['Id']
+        except docker.errors.APIError:
+            parent_id = image.parent_name
+        sha.update(parent_id.encode('utf-8'))
+        sha.update(json.dumps(buildargs or {}, sort_keys=True).encode('utf-8'))
+        sha.update(str(bool(self.conf.squash)).encode('utf-8'))
+        sha.update(context_hash.encode('utf-8'))
+        return sha.hexdigest()
+
+    def make_build_context(self, image):
+        """Create the build context tarball of an image in a single pass.
+
+        Paths excluded by a .dockerignore file are left out and the
+        modification time of every member is set to 0. While the files are
+        added they are hashed for the fingerprint of the image. The parent
+        reference in the FROM line of the Dockerfile is left out of the
+        hash, it only differs by tag between otherwise identical builds.
+
+        With a persistent working directory the context is kept and reused
+        by later runs as long as no file of the image changed.
+
+        :return: a tuple of the tarball file object and the context hash
+        """
+        patterns = list()
+        dockerignore = os.path.join(image.path, '.dockerignore')
+        if os.path.exists(dockerignore):
+            with open(dockerignore) as f:
+                patterns = [line.strip() for line in f.read().splitlines()
+                            if line.strip() and not line.startswith('#')]
+        paths = sorted(docker.utils.exclude_paths(image.path, patterns))
+
+        # NOTE: Copies in the working dir all have an mtime of 0, and their
+        #       ctime and inode change whenever the working dir is created
+        #       again, so the cached context is keyed on the mode, size and
+        #       content of the files.
+        signature = hashlib.sha256()
+        for path in paths:
+            full_path = os.path.join(image.path, path)
+            st = os.lstat(full_path)
+            signature.update(('%s\0%d %d\0' % (
+                path, st.st_mode, st.st_size)).encode('utf-8'))
+            if stat.S_ISLNK(st.st_mode):
+                signature.update(os.readlink(full_path).encode('utf-8'))
+            elif stat.S_ISREG(st.st_mode):
+                with open(full_path, 'rb') as f:
+                    for chunk in iter(lambda: f.read(65536), b''):
+                        signature.update(chunk)
+        signature = signature.hexdigest()
+
+        cached = None
+        if self.conf.work_dir:
+            contexts_dir = os.path.join(self.conf.work_dir, 'contexts')
+            cached = os.path.join(contexts_dir, image.name + '.tar')
+            try:
+                with open(cached + '.json') as f:
+                    meta = json.load(f)
+                if meta['signature'] == signature:
+                    self.logger.debug('Reusing unchanged build context')
+                    image.context_size = os.path.getsize(cached)
+                    return open(cached, 'rb'), meta['hash']
+            except (IOError, ValueError, KeyError):
+                pass
+            if not os.path.isdir(contexts_dir):
+                os.makedirs(contexts_dir)
+            context = open(cached + '.tmp', 'w+b')
+        else:
+            context = tempfile.TemporaryFile()
+
+        sha = hashlib.sha256()
+        with utils.open_tar(fileobj=context) as tar:
+            for path in paths:
+                full_path = os.path.join(image.path, path)
+                info = tar.gettarinfo(full_path, arcname=path)
+                if info is None:
+                    continue
+                utils.normalize_tarinfo(info)
+                sha.update(path.encode('utf-8'))
+                sha.update(b'\0')
+                if info.issym():
+                    sha.update(info.linkname.encode('utf-8'))
+                    tar.addfile(info)
+                elif info.isreg() and path == 'Dockerfile':
+                    with open(full_path, 'rb') as f:
+                        data = f.read()
+                    sha.update(PARENT_SEARCH_PATTERN.sub(b'FROM', data,
+                                                         count=1))
+                    tar.addfile(info, six.BytesIO(data))
+                elif info.isreg():
+                    sha.update(str(info.mode & 0o111).encode('utf-8'))
+                    with open(full_path, 'rb') as f:
+                        tar.addfile(info, HashingReader(f, sha))
+                else:
+                    tar.addfile(info)
+                sha.update(b'\0')
+        context_hash = sha.hexdigest()
+
+        image.context_size = context.tell()
+
+        if cached:
+            context.close()
+            os.rename(cached + '.tmp', cached)
+            with open(cached + '.json', 'w') as f:
+                json.dump({'signature': signature, 'hash': context_hash}, f)
+            context = open(cached, 'rb')
+        context.seek(0)
+        return context, context_hash
+
+    def reuse_image(self, image):
+        """Tag an existing image built from identical inputs.
+
+        :return: True if such an image was found and tagged
+        """
+        image_ids = self.dc.images(
+            filters={'label': '%s=%s' % (FINGERPRINT_LABEL,
+                                         image.fingerprint)},
+            quiet=True)
+        if not image_ids:
+            return False
+        repository, tag = image.canonical_name.rsplit(':', 1)
+        self.dc.tag(image_ids[0], repository, tag, force=True)
+        image.reused = True
+        self.logger.info('Tagged existing image %s with identical'
+                         ' fingerprint %s', image_ids[0], image.fingerprint)
+        return True
+
+    @staticmethod
+    def count_step(image, line):
+        """Count build steps and the ones served from the Docker cache."""
+        if line.startswith('Step '):
+            image.build_steps += 1
+        elif line.strip() == '---> Using cache':
+            image.cache_hits += 1
+
+
+class SquashStage(object):
+    """State shared by the squash tasks of a build.
+
+    The ID of every squashed image is recorded under the fingerprint of
+    the image it was squashed from, in ``squash-cache.json`` of the
+    working directory when --work-dir is set. An image with a known
+    fingerprint is then tagged with its squashed counterpart instead of
+    being squashed again.
+
+    Squash tasks are handed to ``queue`` so that they do not hold build
+    workers, and the children of a squashed image are handed back to
+    ``build_queue``. Without queues squash tasks run in the build queue.
+    """
+
+    def __init__(self, conf, queue=None, build_queue=None):
+        self.conf = conf
+        self.queue = queue
+        self.build_queue = build_queue
+        self.path = None
+        if conf.work_dir:
+            self.path = os.path.join(conf.work_dir, 'squash-cache.json')
+        self._lock = threading.Lock()
+        self._squashed = dict()
+        self._last_layers = dict()
+        if self.path and os.path.exists(self.path):
+            try:
+                with open(self.path) as f:
+                    self._squashed = json.load(f)
+            except (IOError, ValueError) as e:
+                LOG.warning('Ignoring unreadable squash cache %s: %s',
+                            self.path, e)
+
+    def get(self, fingerprint):
+        with self._lock:
+            return self._squashed.get(fingerprint)
+
+    def add(self, fingerprint, image_id):
+        with self._lock:
+            self._squashed[fingerprint] = image_id
+            if not self.path:
+                return
+            tmp_path = self.path + '.tmp'
+            with open(tmp_path, 'w') as f:
+                json.dump(self._squashed, f, indent=2, sort_keys=True)
+            os.rename(tmp_path, self.path)
+
+    def last_layer(self, dc, image_name, docker_host=None):
+        """Return the latest layer of an image, looked up once per build.
+
+        Images are final by the time their children are squashed, so the
+        layer does not change during a build.
+        """
+        key = (docker_host, image_name)
+        with self._lock:
+            layer = self._last_layers.get(key)
+        if layer is None:
+            layer = dc.history(image_name)[0]['Id']
+            with self._lock:
+                self._last_layers[key] = layer
+        return layer
 
-    def squash(self):
-        image_tag = self.image.canonical_name
-        image_id = self.dc.inspect_image(image_tag)['Id']
 
-        parent_history = self.dc.history(self.image.parent_name)
-        parent_last_layer = parent_history[0]['Id']
+class SquashTask(DockerTask):
+    """Task that squashes the layers an image adds to its parent."""
+
+    def __init__(self, conf, image, build_task, stage):
+        super(SquashTask, self).__init__()
+        self.conf = conf
+        self.image = image
+        self.docker_host = image.docker_host
+        self.build_task = build_task
+        self.stage = stage
+        self.logger = image.logger
+        self.attempted = False
+
+    @property
+    def name(self):
+        return 'SquashTask(%s)' % self.image.name
+
+    def run(self):
+        image = self.image
+        if self.attempted and image.status in STATUS_ERRORS:
+            # NOTE: The image itself was built, only squashing is retried.
+            image.status = STATUS_BUILT
+        self.attempted = True
+        try:
+            with image.timed('squash'):
+                self.squash(image)
+        except Exception as e:
+            self.logger.exception('Unknown error when squashing')
+            image.status = STATUS_ERROR
+            self.failure = retry.classify_exception(e)
+        self.success = image.status == STATUS_BUILT
+        if self.success:
+            self.record_built(image, self.build_task.state)
+
+    @property
+    def followups(self):
+        followups = self.build_task.image_followups()
+        if self.stage.build_queue is None:
+            return followups
+        return [next_task if isinstance(next_task, PushIntoQueueTask)
+                else PushIntoQueueTask(next_task, self.stage.build_queue)
+                for next_task in followups]
+
+    def squash(self, image):
+        image_tag = image.canonical_name
+        image_info = self.dc.inspect_image(image_tag)
+        image_id = image_info['Id']
+
+        squashed_id = self.stage.get(image.fingerprint)
+        if squashed_id == image_id:
+            self.logger.info('Image is already squashed')
+            return
+        if squashed_id:
+            try:
+                self.dc.inspect_image(squashed_id)
+            except docker.errors.NotFound:
+                pass
+            else:
+                repository, tag = image_tag.rsplit(':', 1)
+                self.dc.tag(squashed_id, repository, tag, force=True)
+                self.logger.info('Tagged existing squashed image %s',
+                                 squashed_id)
+                return
+
+        parent_last_layer = self.stage.last_layer(self.dc, image.parent_name,
+                                                  self.docker_host)
         self.logger.info('Parent lastest layer is: %s' % parent_last_layer)
 
         utils.squash(image_id, image_tag, from_layer=parent_last_layer,
                      cleanup=self.conf.squash_cleanup,
-                     tmp_dir=self.conf.squash_tmp_dir)
-        self.logger.info('Image is squashed successfully')
+                     tmp_dir=self.conf.squash_tmp_dir,
+                     docker_host=self.docker_host)
+        squashed_info = self.dc.inspect_image(image_tag)
+        self.stage.add(image.fingerprint, squashed_info['Id'])
+        image.squash_bytes_saved = (image_info.get('Size', 0) -
+                                    squashed_info.get('Size', 0))
+        self.logger.info('Image is squashed successfully, saving %d bytes',
+                         image.squash_bytes_saved)
 
 
 class WorkerThread(threading.Thread):
@@ -506,11 +1369,23 @@ class WorkerThread(threading.Thread):
     #: Object to be put on worker queues to get them to die.
     tombstone = object()
 
-    def __init__(self, conf, queue):
+    def __init__(self, conf, queue, tracker=None, retry_policy=None,
+                 followup_queue=None):
         super(WorkerThread, self).__init__()
         self.queue = queue
+        # Queue the followups of tasks are put into, ``queue`` by default.
+        if followup_queue is None:
+            followup_queue = queue
+        self.followup_queue = followup_queue
         self.conf = conf
+        self.tracker = tracker
+        if retry_policy is None:
+            retry_policy = retry.RetryPolicy(conf)
+        self.retry_policy = retry_policy
         self.should_stop = False
+        # Whether a task is running, and how many attempts were retried.
+        self.busy = False
+        self.retries = 0
 
     def run(self):
         while not self.should_stop:
@@ -519,28 +1394,50 @@ class WorkerThread(threading.Thread):
                 # Ensure any other threads also get the tombstone.
                 self.queue.put(task)
                 break
+            self.busy = True
             try:
+                failure = None
                 for attempt in six.moves.range(self.conf.retries + 1):
                     if self.should_stop:
                         break
+                    if attempt:
+                        if not self.retry_policy.should_retry(task, failure):
+                            break
+                        self.retries += 1
+                        delay = self.retry_policy.backoff(attempt)
+                        LOG.info('Retrying %s in %.1fs after a %s failure',
+                                 task.name, delay, failure)
+                        time.sleep(delay)
                     LOG.info("Attempt number: %s to run task: %s ",
                              attempt + 1, task.name)
                     try:
                         task.run()
                         if task.success:
                             break
-                    except Exception:
+                        failure = task.failure or retry.UNKNOWN
+                    except Exception as e:
                         LOG.exception('Unhandled error when running %s',
                                       task.name)
+                        failure = retry.classify_exception(e)
                     # try again...
                     task.reset()
                 if task.success and not self.should_stop:
                     for next_task in task.followups:
+                        if isinstance(next_task, PushIntoQueueTask):
+                            # Hand the push over right away, before the
+                            # children of the image are queued.
+                            next_task.run()
+                            continue
                         LOG.info('Added next task %s to queue',
                                  next_task.name)
-                        self.queue.put(next_task)
+                        self.followup_queue.put(next_task)
             finally:
-                self.queue.task_done()
+                self.busy = False
+                task.release()
+                if self.tracker is not None:
+                    self.tracker.task_done(self.queue)
+                else:
+                    self.queue.task_done()
 
 
 class KollaWorker(object):
@@ -642,12 +1539,41 @@ class KollaWorker(object):
         self.image_statuses_unbuildable = dict()
         self.maintainer = conf.maintainer
         self.distro_python_version = conf.distro_python_version
-
-        docker_kwargs = docker.utils.kwargs_from_env()
+        self._template_values = None
+        self._from_env = None
+        self._from_templates = dict()
+
+        history_file = conf.history_file
+        if not history_file and conf.work_dir:
+            history_file = os.path.join(conf.work_dir, 'build-history.json')
+        if history_file:
+            self.history = build_history.BuildHistory(history_file)
+            self.history.load()
+        else:
+            self.history = None
+
+        if conf.resume and not conf.work_dir:
+            LOG.error('Resuming a build needs the --work-dir it used')
+            sys.exit(1)
+        self.state = None
+        if conf.work_dir:
+            self.state = build_state.BuildState(
+                os.path.join(conf.work_dir, build_state.STATE_FILE),
+                build_state.config_signature(conf))
+
+        pool_size = conf.docker_pool_size
+        if not pool_size:
+            pool_size = conf.threads + conf.push_threads + 1
+        self.docker_hosts = DockerHosts(conf, conf.docker_host, pool_size)
         try:
-            self.dc = docker.APIClient(version='auto', **docker_kwargs)
+            # NOTE: Planning, the image cache and the layer cache use the
+            #       first Docker host when there are several.
+            base_url = conf.docker_host[0] if conf.docker_host else None
+            self.dc = DockerClientPool.instance(
+                pool_size, base_url=base_url).acquire()
         except docker.errors.DockerException as e:
             self.dc = None
+            self.docker_image_index = None
             if not (conf.template_only
                     or conf.save_dependency
                     or conf.list_images
@@ -655,6 +1581,8 @@ class KollaWorker(object):
                 LOG.error("Unable to connect to Docker, exiting")
                 LOG.info("Exception caught: {0}".format(e))
                 sys.exit(1)
+        else:
+            self.docker_image_index = DockerImageIndex(self.dc)
 
     def _get_images_dir(self):
         possible_paths = (
@@ -713,30 +1641,97 @@ class KollaWorker(object):
 
         return rpm_setup
 
-    def copy_apt_files(self):
-        if self.conf.apt_sources_list:
-            shutil.copyfile(
-                self.conf.apt_sources_list,
-                os.path.join(self.working_dir, "base", "sources.list")
-            )
+    def get_working_dir_sources(self):
+        """Map every file of the working dir to the file it is copied from.
 
+        Files of --docker-dir directories override the ones of the images
+        dir, in the order the directories are given.
+        """
+        sources = dict()
+        for src_dir in [self.images_dir] + list(self.conf.docker_dir):
+            for root, dirs, files in os.walk(src_dir, followlinks=True):
+                for name in files:
+                    src_path = os.path.join(root, name)
+                    sources[os.path.relpath(src_path, src_dir)] = src_path
+        if self.conf.apt_sources_list:
+            sources[os.path.join('base', 'sources.list')] = (
+                self.conf.apt_sources_list)
         if self.conf.apt_preferences:
-            shutil.copyfile(
-                self.conf.apt_preferences,
-                os.path.join(self.working_dir, "base", "apt_preferences")
-            )
+            sources[os.path.join('base', 'apt_preferences')] = (
+                self.conf.apt_preferences)
+        return sources
 
-    def copy_dir(self, src, dest):
-        if not os.path.isdir(dest):
-            shutil.copytree(src, dest)
-        else:
-            for file in os.listdir(src):
-                src_path = os.path.join(src, file)
-                dest_path = os.path.join(dest, file)
-                if os.path.isdir(src_path):
-                    self.copy_dir(src_path, dest_path)
-                else:
-                    shutil.copy2(src_path, dest_path)
+    def sync_working_dir(self):
+        """Incrementally copy the image templates into the working dir.
+
+        A manifest of the files copied by the previous run records their
+        size, modification time and content hash. Only new and changed
+        files are copied, with their timestamps set to epoch 0, and files
+        that are no longer provided are removed.
+        """
+        manifest_path = self.working_dir + '-manifest.json'
+        try:
+            with open(manifest_path) as f:
+                old_manifest = json.load(f)
+        except (IOError, ValueError):
+            old_manifest = dict()
+
+        manifest = dict()
+        copied = 0
+        for rel_path, src_path in sorted(
+                self.get_working_dir_sources().items()):
+            dest_path = os.path.join(self.working_dir, rel_path)
+            st = os.stat(src_path)
+            entry = old_manifest.get(rel_path)
+            if (entry and entry['size'] == st.st_size and
+                    entry['mtime'] == st.st_mtime):
+                digest = entry['sha256']
+            else:
+                sha = hashlib.sha256()
+                with open(src_path, 'rb') as f:
+                    for chunk in iter(lambda: f.read(65536), b''):
+                        sha.update(chunk)
+                digest = sha.hexdigest()
+            manifest[rel_path] = {'size': st.st_size,
+                                  'mtime': st.st_mtime,
+                                  'sha256': digest}
+
+            try:
+                dest_st = os.stat(dest_path)
+            except OSError:
+                dest_st = None
+            # NOTE: A chmod only changes the ctime of the source, compare
+            #       the mode of the copy as well.
+            if (entry and entry['sha256'] == digest and dest_st and
+                    dest_st.st_size == st.st_size and dest_st.st_mtime == 0
+                    and dest_st.st_mode == st.st_mode):
+                continue
+            dest_dir = os.path.dirname(dest_path)
+            if not os.path.isdir(dest_dir):
+                os.makedirs(dest_dir)
+            shutil.copyfile(src_path, dest_path)
+            shutil.copymode(src_path, dest_path)
+            os.utime(dest_path, (0, 0))
+            copied += 1
+
+        removed = 0
+        for rel_path in set(old_manifest) - set(manifest):
+            dest_path = os.path.join(self.working_dir, rel_path)
+            if os.path.exists(dest_path):
+                os.remove(dest_path)
+                removed += 1
+            dest_dir = os.path.dirname(dest_path)
+            while (dest_dir != self.working_dir and
+                   os.path.isdir(dest_dir) and not os.listdir(dest_dir)):
+                os.rmdir(dest_dir)
+                dest_dir = os.path.dirname(dest_dir)
+
+        with open(manifest_path + '.tmp', 'w') as f:
+            json.dump(manifest, f)
+        os.rename(manifest_path + '.tmp', manifest_path)
+        LOG.debug('Synced working dir: %d files copied, %d removed,'
+                  ' %d unchanged', copied, removed,
+                  len(manifest) - copied)
 
     def setup_working_dir(self):
         """Creates a working directory for use while building."""
@@ -748,20 +1743,9 @@ class KollaWorker(object):
                 '%Y-%m-%d_%H-%M-%S_')
             self.temp_dir = tempfile.mkdtemp(prefix='kolla-' + ts)
             self.working_dir = os.path.join(self.temp_dir, 'docker')
-        self.copy_dir(self.images_dir, self.working_dir)
-        for dir in self.conf.docker_dir:
-            self.copy_dir(dir, self.working_dir)
-        self.copy_apt_files()
+        self.sync_working_dir()
         LOG.debug('Created working dir: %s', self.working_dir)
 
-    def set_time(self):
-        for root, dirs, files in os.walk(self.working_dir):
-            for file_ in files:
-                os.utime(os.path.join(root, file_), (0, 0))
-            for dir_ in dirs:
-                os.utime(os.path.join(root, dir_), (0, 0))
-        LOG.debug('Set atime and mtime to 0 for all content in working dir')
-
     def _get_filters(self):
         filters = {
             'customizable': jinja_filters.customizable,
@@ -793,65 +1777,175 @@ class KollaWorker(object):
                 }
         return ret
 
-    def create_dockerfiles(self):
-        kolla_version = version.version_info.cached_version_string()
-        supported_distro_release = common_config.DISTRO_RELEASE.get(
-            self.base)
-        for path in self.docker_build_paths:
+    def _make_jinja_env(self, loader):
+        env = jinja2.Environment(  # nosec: not used to render HTML
+            loader=loader)
+        env.filters.update(self._get_filters())
+        env.globals.update(self._get_methods())
+        return env
+
+    def get_shared_templates_hash(self):
+        """Hash the templates Dockerfiles may include, like macros.j2."""
+        sha = hashlib.sha256()
+        for root, dirs, names in os.walk(self.working_dir):
+            dirs.sort()
+            for name in sorted(names):
+                if not name.endswith('.j2') or name == 'Dockerfile.j2':
+                    continue
+                path = os.path.join(root, name)
+                sha.update(os.path.relpath(path, self.working_dir)
+                           .encode('utf-8'))
+                with open(path, 'rb') as f:
+                    sha.update(f.read())
+        return sha.hexdigest()
+
+    def get_template_values(self, image_name):
+        """Values the Dockerfile template of an image is rendered with."""
+        if self._template_values is None:
+            ts = time.time()
+            self._template_values = {
+                'base_distro': self.base,
+                'base_image': self.conf.base_image,
+                'base_distro_tag': self.base_tag,
+                'base_arch': self.base_arch,
+                'use_dumb_init': self.use_dumb_init,
+                'base_package_type': self.base_package_type,
+                'debian_arch': self.debian_arch,
+                'supported_distro_release': common_config.DISTRO_RELEASE.get(
+                    self.base),
+                'install_metatype': self.install_metatype,
+                'image_prefix': self.image_prefix,
+                'install_type': self.install_type,
+                'namespace': self.namespace,
+                'ceph_version': self.ceph_version,
+                'ceph_release': self.ceph_release,
+                'tag': self.tag,
+                'maintainer': self.maintainer,
+                'kolla_version':
+                    version.version_info.cached_version_string(),
+                'users': self.get_users(),
+                'distro_python_version': self.distro_python_version,
+                'distro_package_manager': self.distro_package_manager,
+                'rpm_setup': self.rpm_setup,
+                'build_date': datetime.datetime.fromtimestamp(ts).strftime(
+                    '%Y%m%d'),
+                'clean_package_cache': self.clean_package_cache}
+        values = dict(self._template_values)
+        values['image_name'] = image_name
+        return values
+
+    def get_parent_name(self, path):
+        """Find the parent of an image without rendering its Dockerfile.
+
+        Only the FROM line of the template is rendered. Return None when
+        that line cannot be rendered on its own, because it comes after
+        template statements or fails to render without the rest of the
+        template. The whole template has to be rendered then.
+        """
+        with open(os.path.join(path, 'Dockerfile.j2')) as f:
+            source = f.read()
+        match = re.search(r'^FROM.*$', source, re.MULTILINE)
+        if not match or '{%' in source[:match.start()]:
+            return None
+        # NOTE: Most images share a handful of FROM lines, compile each once.
+        from_line = match.group(0)
+        try:
+            template = self._from_templates.get(from_line)
+            if template is None:
+                if self._from_env is None:
+                    self._from_env = self._make_jinja_env(
+                        jinja2.BaseLoader())
+                template = self._from_env.from_string(from_line)
+                self._from_templates[from_line] = template
+            line = template.render(
+                self.get_template_values(os.path.basename(path)),
+                env=os.environ)
+        except jinja2.TemplateError:
+            return None
+        return line.split(' ')[1]
+
+    def create_dockerfiles(self, paths=None):
+        """Render the Dockerfile of the images in ``paths``, or of all.
+
+        Rendering is skipped for images whose template, shared templates,
+        template overrides and values are unchanged since the previous run
+        and whose Dockerfile is still in place.
+        """
+        if paths is None:
+            paths = self.docker_build_paths
+        if not paths:
+            return
+        env = self._make_jinja_env(jinja2.FileSystemLoader(self.working_dir))
+
+        shared_sha = hashlib.sha256()
+        shared_sha.update(self.get_shared_templates_hash().encode('utf-8'))
+        shared_sha.update(json.dumps(sorted(os.environ.items()))
+                          .encode('utf-8'))
+        override_template = None
+        if self.conf.template_override:
+            tpl_dict = self._merge_overrides(self.conf.template_override)
+            override_name = list(tpl_dict.keys())[0]
+            override_env = self._make_jinja_env(jinja2.DictLoader(tpl_dict))
+            override_template = override_env.get_template(override_name)
+            shared_sha.update(tpl_dict[override_name].encode('utf-8'))
+        shared_hash = shared_sha.hexdigest()
+
+        cache_path = self.working_dir + '-render-cache.json'
+        try:
+            with open(cache_path) as f:
+                render_cache = json.load(f)
+        except (IOError, ValueError):
+            render_cache = dict()
+
+        rendered = 0
+        for path in paths:
             template_name = "Dockerfile.j2"
             image_name = path.split("/")[-1]
-            ts = time.time()
-            build_date = datetime.datetime.fromtimestamp(ts).strftime(
-                '%Y%m%d')
-            values = {'base_distro': self.base,
-                      'base_image': self.conf.base_image,
-                      'base_distro_tag': self.base_tag,
-                      'base_arch': self.base_arch,
-                      'use_dumb_init': self.use_dumb_init,
-                      'base_package_type': self.base_package_type,
-                      'debian_arch': self.debian_arch,
-                      'supported_distro_release': supported_distro_release,
-                      'install_metatype': self.install_metatype,
-                      'image_prefix': self.image_prefix,
-                      'install_type': self.install_type,
-                      'namespace': self.namespace,
-                      'ceph_version': self.ceph_version,
-                      'ceph_release': self.ceph_release,
-                      'tag': self.tag,
-                      'maintainer': self.maintainer,
-                      'kolla_version': kolla_version,
-                      'image_name': image_name,
-                      'users': self.get_users(),
-                      'distro_python_version': self.distro_python_version,
-                      'distro_package_manager': self.distro_package_manager,
-                      'rpm_setup': self.rpm_setup,
-                      'build_date': build_date,
-                      'clean_package_cache': self.clean_package_cache}
-            env = jinja2.Environment(  # nosec: not used to render HTML
-                loader=jinja2.FileSystemLoader(self.working_dir))
-            env.filters.update(self._get_filters())
-            env.globals.update(self._get_methods())
+            values = self.get_template_values(image_name)
             tpl_path = os.path.join(
                 os.path.relpath(path, self.working_dir),
                 template_name)
+            content_path = os.path.join(path, 'Dockerfile')
+
+            sha = hashlib.sha256()
+            sha.update(shared_hash.encode('utf-8'))
+            with open(os.path.join(path, template_name), 'rb') as f:
+                sha.update(f.read())
+            sha.update(json.dumps(values, sort_keys=True, default=str)
+                       .encode('utf-8'))
+            render_key = sha.hexdigest()
+            if (render_cache.get(tpl_path) == render_key and
+                    os.path.exists(content_path)):
+                LOG.debug("Template %s is unchanged, not rendering it",
+                          tpl_path)
+                self.rendered_paths.add(path)
+                continue
 
             template = env.get_template(tpl_path)
-            if self.conf.template_override:
-                tpl_dict = self._merge_overrides(self.conf.template_override)
-                template_name = os.path.basename(list(tpl_dict.keys())[0])
+            if override_template is not None:
                 values['parent_template'] = template
-                env = jinja2.Environment(  # nosec: not used to render HTML
-                    loader=jinja2.DictLoader(tpl_dict))
-                env.filters.update(self._get_filters())
-                env.globals.update(self._get_methods())
-                template = env.get_template(template_name)
+                template = override_template
             content = template.render(values, env=os.environ)
-            content_path = os.path.join(path, 'Dockerfile')
             with open(content_path, 'w') as f:
                 LOG.debug("Rendered %s into:", tpl_path)
                 LOG.debug(content)
                 f.write(content)
                 LOG.debug("Wrote it to %s", content_path)
+            render_cache[tpl_path] = render_key
+            self.rendered_paths.add(path)
+            rendered += 1
+
+        with open(cache_path + '.tmp', 'w') as f:
+            json.dump(render_cache, f)
+        os.rename(cache_path + '.tmp', cache_path)
+        LOG.debug('Rendered %d of %d Dockerfiles', rendered, len(paths))
+
+    def create_selected_dockerfiles(self):
+        """Render the Dockerfiles of the images selected to be built."""
+        self.create_dockerfiles([
+            image.path for image in self.images
+            if image.status == STATUS_MATCHED and
+            image.path not in self.rendered_paths])
 
     def _merge_overrides(self, overrides):
         tpl_name = os.path.basename(overrides[0])
@@ -868,6 +1962,7 @@ class KollaWorker(object):
     def find_dockerfiles(self):
         """Recursive search for Dockerfiles in the working directory."""
         self.docker_build_paths = list()
+        self.rendered_paths = set()
         path = self.working_dir
         filename = 'Dockerfile.j2'
 
@@ -913,36 +2008,26 @@ class KollaWorker(object):
 
         if unbuildable_images:
             for image in self.images:
-                if image.name in unbuildable_images:
+                if (image.name in unbuildable_images or
+                        any(ancestor.name in unbuildable_images
+                            for ancestor in self.get_ancestors(image))):
                     image.status = STATUS_UNBUILDABLE
-                else:
-                    # let's check ancestors
-                    # if any of them is unbuildable then we mark it
-                    # and then mark image
-                    build_image = True
-                    ancestor_image = image
-                    while (ancestor_image.parent is not None):
-                        ancestor_image = ancestor_image.parent
-                        if ancestor_image.name in unbuildable_images or \
-                           ancestor_image.status == STATUS_UNBUILDABLE:
-                            build_image = False
-                            ancestor_image.status = STATUS_UNBUILDABLE
-                            break
-                    if not build_image:
-                        image.status = STATUS_UNBUILDABLE
 
         # When we want to build a subset of images then filter_ part kicks in.
         # Otherwise we just mark everything buildable as matched for build.
 
         if filter_:
             patterns = re.compile(r"|".join(filter_).join('()'))
+            matched = set()
+            ancestors = set()
             for image in self.images:
-                # as we now list not buildable/skipped images we need to
-                # process them otherwise list will contain also not requested
-                # entries
-                if image.status == STATUS_MATCHED:
-                    continue
                 if re.search(patterns, image.name):
+                    matched.add(image.canonical_name)
+                    ancestors.update(ancestor.canonical_name for ancestor
+                                     in self.get_ancestors(image))
+
+            for image in self.images:
+                if image.canonical_name in matched:
                     if image.status not in [STATUS_SKIPPED,
                                             STATUS_UNBUILDABLE]:
                         image.status = STATUS_MATCHED
@@ -951,22 +2036,16 @@ class KollaWorker(object):
                     # was already built
                     if (self.conf.skip_existing and image.in_docker_cache()):
                         image.status = STATUS_SKIPPED
-
-                    # handle image ancestors
-                    ancestor_image = image
-                    while (ancestor_image.parent is not None and
-                           ancestor_image.parent.status not in
-                           (STATUS_MATCHED, STATUS_SKIPPED)):
-                        ancestor_image = ancestor_image.parent
-                        if self.conf.skip_parents:
-                            ancestor_image.status = STATUS_SKIPPED
-                        elif (self.conf.skip_existing and
-                              ancestor_image.in_docker_cache()):
-                            ancestor_image.status = STATUS_SKIPPED
-                        else:
-                            if ancestor_image.status != STATUS_UNBUILDABLE:
-                                ancestor_image.status = STATUS_MATCHED
-                        LOG.debug('Image %s matched regex', image.name)
+                    LOG.debug('Image %s matched regex', image.name)
+                elif image.canonical_name in ancestors:
+                    # ancestors of matched images are needed to build them
+                    if self.conf.skip_parents:
+                        image.status = STATUS_SKIPPED
+                    elif (self.conf.skip_existing and
+                          image.in_docker_cache()):
+                        image.status = STATUS_SKIPPED
+                    elif image.status != STATUS_UNBUILDABLE:
+                        image.status = STATUS_MATCHED
                 else:
                     # we do not care if it is skipped or not as we did not
                     # request it
@@ -980,11 +2059,19 @@ class KollaWorker(object):
         """Walk the dictionary of images statuses and print results."""
         # For debug we print the logs again if the image error'd. This is to
         # help us debug and it will be extra helpful in the gate.
+        utils.flush_logs()
         for image in self.images:
             if image.status in STATUS_ERRORS:
                 LOG.debug("Image %s failed", image.name)
+                lines = utils.get_log_buffer(image.logger)
+                if lines:
+                    LOG.info('Last %d log lines of image %s:', len(lines),
+                             image.name)
+                    for line in lines:
+                        LOG.info('%s', line)
 
         self.get_image_statuses()
+        images = dict((image.name, image) for image in self.images)
         results = {
             'built': [],
             'failed': [],
@@ -999,9 +2086,7 @@ class KollaWorker(object):
             LOG.info("=========================")
             for name in sorted(self.image_statuses_good.keys()):
                 LOG.info(name)
-                results['built'].append({
-                    'name': name,
-                })
+                results['built'].append(self.get_image_stats(images[name]))
 
         if self.image_statuses_bad:
             LOG.info("===========================")
@@ -1009,10 +2094,9 @@ class KollaWorker(object):
             LOG.info("===========================")
             for name, status in sorted(self.image_statuses_bad.items()):
                 LOG.error('%s Failed with status: %s', name, status)
-                results['failed'].append({
-                    'name': name,
-                    'status': status,
-                })
+                stats = self.get_image_stats(images[name])
+                stats['status'] = status
+                results['failed'].append(stats)
                 if self.conf.logs_dir and status == STATUS_ERROR:
                     linkname = os.path.join(self.conf.logs_dir,
                                             "000_FAILED_%s.log" % name)
@@ -1054,8 +2138,67 @@ class KollaWorker(object):
                     'name': name,
                 })
 
+        timed_images = [image for image in self.images if image.timings]
+        if timed_images:
+            LOG.info("===============")
+            LOG.info("Build durations")
+            LOG.info("===============")
+            for image in sorted(timed_images,
+                                key=lambda i: i.timings.get('build', 0),
+                                reverse=True):
+                LOG.info('%s: %s', image.name, ', '.join(
+                    '%s %.1fs' % (phase, image.timings[phase])
+                    for phase in build_history.PHASES
+                    if phase in image.timings))
+                average = (self.history.average(image.name)
+                           if self.history else None)
+                if (average and image.status == STATUS_BUILT and
+                        image.timings.get('build', 0) >
+                        average * BUILD_REGRESSION_FACTOR):
+                    LOG.warning('%s took %.1fs to build, %.1fs on average',
+                                image.name, image.timings['build'],
+                                average)
+
+        pushed_images = [image for image in self.images if image.push_stats]
+        if pushed_images:
+            totals = dict.fromkeys(('layers_pushed', 'layers_skipped',
+                                    'bytes_pushed', 'bytes_skipped'), 0)
+            for image in pushed_images:
+                for key in totals:
+                    totals[key] += image.push_stats.get(key, 0)
+            LOG.info('Pushes of %d images: %d layers uploaded (%d bytes),'
+                     ' %d layers already in the registry (%d bytes known),'
+                     ' %d images skipped', len(pushed_images),
+                     totals['layers_pushed'], totals['bytes_pushed'],
+                     totals['layers_skipped'], totals['bytes_skipped'],
+                     len([image for image in pushed_images
+                          if image.push_stats.get('skipped')]))
+
         return results
 
+    def get_image_stats(self, image):
+        """Timings of an image as reported in the summary results."""
+        stats = {'name': image.name}
+        if image.timings:
+            stats['durations'] = dict(
+                (phase, round(duration, 3))
+                for phase, duration in image.timings.items())
+        if image.cache_hit_ratio is not None:
+            stats['cache_hit_ratio'] = round(image.cache_hit_ratio, 3)
+        if image.fingerprint:
+            stats['fingerprint'] = image.fingerprint
+        if image.reused:
+            stats['reused'] = True
+        if image.push_digest:
+            stats['push_digest'] = image.push_digest
+        if image.push_stats:
+            stats['push'] = dict(image.push_stats)
+        if image.squash_bytes_saved is not None:
+            stats['squash_bytes_saved'] = image.squash_bytes_saved
+        if image.docker_host:
+            stats['docker_host'] = image.docker_host
+        return stats
+
     def get_image_statuses(self):
         if any([self.image_statuses_bad,
                 self.image_statuses_good,
@@ -1098,30 +2241,46 @@ class KollaWorker(object):
                 installation['name'] = section
                 if installation['type'] == 'git':
                     installation['reference'] = self.conf[section]['reference']
+                elif (installation['type'] == 'url' and
+                      self.conf[section]['sha256']):
+                    installation['sha256'] = self.conf[section]['sha256']
             return installation
 
         all_sections = (set(six.iterkeys(self.conf._groups)) |
                         set(self.conf.list_all_sections()))
 
+        # NOTE: Dockerfiles are only rendered once images are selected,
+        #       unless finding the parent of an image needs them.
+        parent_names = dict()
         for path in self.docker_build_paths:
-            # Reading parent image name
-            with open(os.path.join(path, 'Dockerfile')) as f:
-                content = f.read()
+            if path not in self.rendered_paths:
+                parent_names[path] = self.get_parent_name(path)
+        self.create_dockerfiles([path for path, parent_name
+                                 in parent_names.items()
+                                 if parent_name is None])
+
+        for path in self.docker_build_paths:
+            parent_name = parent_names.get(path)
+            if parent_name is None:
+                # Reading parent image name
+                with open(os.path.join(path, 'Dockerfile')) as f:
+                    content = f.read()
+                parent_search_pattern = re.compile(r'^FROM.*$', re.MULTILINE)
+                match = re.search(parent_search_pattern, content)
+                if match:
+                    parent_name = match.group(0).split(' ')[1]
+                else:
+                    parent_name = ''
+                del match
 
             image_name = os.path.basename(path)
             canonical_name = (self.namespace + '/' + self.image_prefix +
                               image_name + ':' + self.tag)
-            parent_search_pattern = re.compile(r'^FROM.*$', re.MULTILINE)
-            match = re.search(parent_search_pattern, content)
-            if match:
-                parent_name = match.group(0).split(' ')[1]
-            else:
-                parent_name = ''
-            del match
             image = Image(image_name, canonical_name, path,
                           parent_name=parent_name,
                           logger=utils.make_a_logger(self.conf, image_name),
-                          docker_client=self.dc)
+                          docker_client=self.dc,
+                          image_index=self.docker_image_index)
 
             if self.install_type == 'source':
                 # NOTE(jeffrey4l): register the opts if the section didn't
@@ -1214,40 +2373,284 @@ class KollaWorker(object):
 
     def find_parents(self):
         """Associate all images with parents and children."""
-        sort_images = dict()
+        self.image_index = dict((image.canonical_name, image)
+                                for image in self.images)
+        self._ancestors = dict()
+
+        for image in self.images:
+            parent = self.image_index.get(image.parent_name)
+            if parent is not None:
+                parent.children.append(image)
+                image.parent = parent
+
+    def get_ancestors(self, image):
+        """Return the ancestors of an image, its parent first.
+
+        Ancestors are memoized for every image on the way up, so that
+        looking up the ancestors of all images is linear in their number.
+        """
+        chain = list()
+        node = image
+        while node is not None and node.canonical_name not in self._ancestors:
+            chain.append(node)
+            node = node.parent
+        for node in reversed(chain):
+            if node.parent is None:
+                ancestors = ()
+            else:
+                ancestors = ((node.parent,) +
+                             self._ancestors[node.parent.canonical_name])
+            self._ancestors[node.canonical_name] = ancestors
+        return self._ancestors[image.canonical_name]
+
+    def get_image_weight(self, image):
+        """Estimated cost of building a single image.
+
+        This is the average build duration recorded in the build history.
+        Images without any history weigh the average of all known images.
+        """
+        if self.history is None:
+            return 1
+        weight = self.history.average(image.name)
+        if weight is None:
+            weight = self.history.average_all()
+        return weight or 1
+
+    def save_history(self):
+        """Record the durations of the images built in this run."""
+        if self.history is None:
+            return
+        self.history.add_run([image for image in self.images
+                              if image.status == STATUS_BUILT])
+        self.history.save()
+
+    def prioritize_images(self):
+        """Rank images by the length of their remaining critical path.
+
+        The critical path of an image is its own weight plus the longest
+        critical path of its matched children. Building images with the
+        longest critical path first keeps long dependency chains such as
+        base -> ceph-base -> ceph-osd from waiting behind short leaf images.
+        """
+        def visit(image):
+            if image.critical_path:
+                return image.critical_path
+            image.weight = self.get_image_weight(image)
+            longest_child = 0
+            for child in image.children:
+                if child.status in (STATUS_UNMATCHED, STATUS_SKIPPED,
+                                    STATUS_UNBUILDABLE):
+                    continue
+                longest_child = max(longest_child, visit(child))
+            image.critical_path = image.weight + longest_child
+            return image.critical_path
 
         for image in self.images:
-            sort_images[image.canonical_name] = image
+            visit(image)
+            LOG.debug('Image %s has critical path %s', image.name,
+                      image.critical_path)
 
-        for parent_name, parent in sort_images.items():
-            for image in sort_images.values():
-                if image.parent_name == parent_name:
-                    parent.children.append(image)
-                    image.parent = parent
+    def get_build_order(self):
+        """List the images to build in the order they are expected to.
 
-    def build_queue(self, push_queue):
+        Parents come before their children, images on the longest
+        critical path first.
+        """
+        images = [image for image in self.images
+                  if image.status not in (STATUS_UNMATCHED, STATUS_SKIPPED,
+                                          STATUS_UNBUILDABLE, STATUS_BUILT)]
+        return sorted(images, key=lambda image: (self.get_depth(image),
+                                                 -image.critical_path))
+
+    @staticmethod
+    def get_depth(image):
+        """Number of ancestors of an image."""
+        depth = 0
+        while image.parent is not None:
+            image = image.parent
+            depth += 1
+        return depth
+
+    def resume(self):
+        """Restore the images a previous run finished, see --resume.
+
+        An image recorded as built, or built but not pushed, is restored
+        when its parent was restored too and Docker still has the image it
+        recorded, which is tagged again if the tag moved since. Restored
+        images are not built again and are only pushed when their push did
+        not finish.
+        """
+        if not self.conf.resume or self.state is None:
+            return
+        self.state.load()
+        hosts = self.conf.docker_host or [None]
+        restored = 0
+        for image in self.get_build_order():
+            if image.status != STATUS_MATCHED:
+                continue
+            if (image.parent is not None and
+                    image.parent.status == STATUS_MATCHED):
+                continue
+            entry = self.state.get(image.name)
+            if (not entry or entry.get('status') not in (
+                    STATUS_BUILT, STATUS_PUSH_ERROR,
+                    STATUS_CONNECTION_ERROR) or
+                    not entry.get('id') or
+                    entry.get('canonical_name') != image.canonical_name or
+                    entry.get('docker_host') not in hosts):
+                continue
+            pool = DockerClientPool.instance(base_url=entry['docker_host'])
+            dc = pool.acquire()
+            try:
+                if not self.restore_image(dc, image, entry['id']):
+                    continue
+            finally:
+                pool.release(dc)
+            image.status = STATUS_BUILT
+            image.docker_host = entry['docker_host']
+            image.push_digest = entry.get('push_digest')
+            restored += 1
+        LOG.info('Resuming the build, %d images were built by the previous'
+                 ' run', restored)
+
+    def restore_image(self, dc, image, image_id):
+        try:
+            dc.inspect_image(image_id)
+        except docker.errors.NotFound:
+            image.logger.info('Building again, image %s no longer exists',
+                              image_id)
+            return False
+        try:
+            current_id = dc.inspect_image(image.canonical_name)['Id']
+        except docker.errors.NotFound:
+            current_id = None
+        if current_id != image_id:
+            repository, tag = image.canonical_name.rsplit(':', 1)
+            dc.tag(image_id, repository, tag, force=True)
+            image.logger.info('Tagged image %s built by the previous run',
+                              image_id)
+        return True
+
+    def save_state(self):
+        """Record the final status of the images processed in this run."""
+        if self.state is None:
+            return
+        self.state.record_all([image for image in self.images
+                               if image.status not in (STATUS_UNMATCHED,
+                                                       STATUS_UNPROCESSED)])
+
+    def assign_docker_hosts(self):
+        """Spread the images to build over the hosts given by --docker-host.
+
+        Images sharing a parent always go to the same host, so that they
+        share its layers. Sibling groups are assigned parents first, each
+        to the least loaded host by image weight. A group stays on the host
+        of its parent as long as that host is not loaded more than the
+        weight of the parent itself, taken as the cost of copying it.
+        """
+        hosts = self.conf.docker_host
+        if not hosts:
+            return
+        load = dict((host, 0) for host in hosts)
+        groups = collections.OrderedDict()
+        for image in self.get_build_order():
+            if image.parent is not None:
+                key = image.parent.canonical_name
+            else:
+                key = image.parent_name
+            groups.setdefault(key, []).append(image)
+
+        for members in groups.values():
+            weight = sum(image.weight for image in members)
+            host = min(hosts, key=lambda h: load[h])
+            parent = members[0].parent
+            if (parent is not None and parent.docker_host and
+                    load[parent.docker_host] - load[host] <= parent.weight):
+                host = parent.docker_host
+            load[host] += weight
+            for image in members:
+                image.docker_host = host
+                LOG.debug('Image %s will be built on %s', image.name, host)
+        for host in hosts:
+            LOG.info('Building %d images on %s', len(
+                [image for image in self.images if image.docker_host == host]),
+                host)
+
+    def import_cache(self):
+        """Seed the Docker cache with the layer cache given by --cache-import.
+
+        Imported images are used as build cache of the image they were
+        built as.
+        """
+        if not self.conf.cache_import:
+            return
+        images = [image for image in self.images
+                  if image.status == STATUS_MATCHED]
+        imported = layer_cache.import_cache(self.dc, self.conf.cache_import,
+                                            images)
+        for image in images:
+            if image.name in imported:
+                image.cache_from = [imported[image.name]]
+
+    def export_cache(self):
+        """Save the images built in this run to the --cache-export bundle."""
+        if not self.conf.cache_export:
+            return
+        images = [image for image in self.images
+                  if image.status == STATUS_BUILT]
+        layer_cache.export_cache(self.dc, self.conf.cache_export, images)
+
+    def build_queue(self, push_queue, fetcher=None, squash_queue=None):
         """Organizes Queue list.
 
-        Return a list of Queues that have been organized into a hierarchy
-        based on dependencies
+        Return a priority queue seeded with the root images. Followup tasks
+        are handed out by the length of their remaining critical path. When
+        a source fetcher is given it starts prefetching the sources of all
+        images to build right away. When a squash queue is given, images
+        are squashed by the workers of that queue.
         """
         self.build_image_list()
         self.find_parents()
         self.filter_images()
-
-        queue = six.moves.queue.Queue()
+        self.resume()
+        self.create_selected_dockerfiles()
+        self.prioritize_images()
+        self.assign_docker_hosts()
+        if fetcher is not None:
+            fetcher.start(self.get_build_order())
+        push_scheduler = PushScheduler(self.conf)
+
+        queue = HostTaskQueues(self.conf.docker_host)
+        squash_stage = SquashStage(self.conf, squash_queue, queue)
+
+        # NOTE: Images restored by resume() may only have their push left.
+        #       Parents are queued first, so that a push worker never waits
+        #       for the push of a parent queued behind its child.
+        if self.conf.push:
+            restored = [image for image in self.images
+                        if image.status == STATUS_BUILT and
+                        not image.push_digest]
+            for image in sorted(restored, key=self.get_depth):
+                push_scheduler.expect(image)
+                push_queue.put(PushTask(self.conf, image, push_scheduler,
+                                        self.state))
+                LOG.info('Added image %s to push queue', image.name)
 
         for image in self.images:
             if image.status in (STATUS_UNMATCHED, STATUS_SKIPPED,
-                                STATUS_UNBUILDABLE):
+                                STATUS_UNBUILDABLE, STATUS_BUILT):
                 # Don't bother queuing up build tasks for things that
                 # were not matched in the first place... (not worth the
                 # effort to run them, if they won't be used anyway).
                 continue
             # Build all root nodes, where a root is defined as having no parent
-            # or having a parent that is explicitly being skipped.
-            if image.parent is None or image.parent.status == STATUS_SKIPPED:
-                queue.put(BuildTask(self.conf, image, push_queue))
+            # or having a parent that is explicitly being skipped or was
+            # built by the run being resumed.
+            if image.parent is None or image.parent.status in (STATUS_SKIPPED,
+                                                               STATUS_BUILT):
+                queue.put(BuildTask(self.conf, image, push_queue, fetcher,
+                                    push_scheduler, squash_stage,
+                                    self.docker_hosts, self.state))
                 LOG.info('Added image %s to queue', image.name)
 
         return queue
@@ -1273,16 +2676,15 @@ def run_build():
     kolla = KollaWorker(conf)
     kolla.setup_working_dir()
     kolla.find_dockerfiles()
-    kolla.create_dockerfiles()
+    # NOTE: Template overrides may change any part of a Dockerfile, parents
+    #       cannot be found without rendering them in full.
+    if conf.template_only or conf.template_override:
+        kolla.create_dockerfiles()
 
     if conf.template_only:
         LOG.info('Dockerfiles are generated in %s', kolla.working_dir)
         return
 
-    # We set the atime and mtime to 0 epoch to preserve allow the Docker cache
-    # to work like we want. A different size or hash will still force a rebuild
-    kolla.set_time()
-
     if conf.save_dependency:
         kolla.build_image_list()
         kolla.find_parents()
@@ -1305,38 +2707,79 @@ def run_build():
         return
 
     push_queue = six.moves.queue.Queue()
-    queue = kolla.build_queue(push_queue)
+    squash_queue = six.moves.queue.Queue()
+    fetcher = sources.SourceFetcher(conf)
+    queue = kolla.build_queue(push_queue, fetcher, squash_queue)
+    tracker = TaskTracker(queue, push_queue, squash_queue)
+    retry_policy = retry.RetryPolicy(conf)
+    kolla.import_cache()
     workers = []
+    exporter = None
+    if conf.metrics_file or conf.metrics_port:
+        exporter = build_metrics.MetricsExporter(
+            build_metrics.BuildMetrics(kolla.images,
+                                       {'build': queue,
+                                        'push': push_queue,
+                                        'squash': squash_queue},
+                                       workers, fetcher),
+            conf.metrics_file, conf.metrics_port)
+        exporter.start()
+    controller = None
+    if conf.adaptive_threads:
+        controller = concurrency.ConcurrencyController(
+            conf, kolla.docker_hosts.slots,
+            lambda host: DockerClientPool.instance(base_url=host))
+        controller.start()
 
     with join_many(workers):
         try:
-            for x in six.moves.range(conf.threads):
-                worker = WorkerThread(conf, queue)
-                worker.setDaemon(True)
-                worker.start()
-                workers.append(worker)
+            # NOTE: Each Docker host builds up to --threads images.
+            for host_queue in queue.queues.values():
+                for x in six.moves.range(conf.threads):
+                    worker = WorkerThread(conf, host_queue, tracker,
+                                          retry_policy, followup_queue=queue)
+                    worker.setDaemon(True)
+                    worker.start()
+                    workers.append(worker)
 
             for x in six.moves.range(conf.push_threads):
-                worker = WorkerThread(conf, push_queue)
+                worker = WorkerThread(conf, push_queue, tracker,
+                                      retry_policy)
                 worker.setDaemon(True)
                 worker.start()
                 workers.append(worker)
 
-            # sleep until queue is empty
-            while queue.unfinished_tasks or push_queue.unfinished_tasks:
-                time.sleep(3)
+            if conf.squash:
+                for x in six.moves.range(conf.squash_threads):
+                    worker = WorkerThread(conf, squash_queue, tracker,
+                                          retry_policy)
+                    worker.setDaemon(True)
+                    worker.start()
+                    workers.append(worker)
+
+            # wait until both queues are drained
+            tracker.wait()
+            if controller is not None:
+                controller.stop()
+            if exporter is not None:
+                exporter.stop()
 
             # ensure all threads exited happily
             push_queue.put(WorkerThread.tombstone)
+            squash_queue.put(WorkerThread.tombstone)
             queue.put(WorkerThread.tombstone)
         except KeyboardInterrupt:
             for w in workers:
                 w.should_stop = True
             push_queue.put(WorkerThread.tombstone)
+            squash_queue.put(WorkerThread.tombstone)
             queue.put(WorkerThread.tombstone)
             raise
 
     results = kolla.summary()
+    kolla.save_state()
+    kolla.save_history()
+    kolla.export_cache()
     kolla.cleanup()
     if conf.format == 'json':
         print(json.dumps(results))
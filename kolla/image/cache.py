@@ -0,0 +1,167 @@
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import glob
+import hashlib
+import json
+import os
+
+from kolla.common import utils
+
+
+LOG = utils.make_a_logger()
+
+# Name of the manifest describing a layer cache bundle directory.
+MANIFEST = 'manifest.json'
+
+
+def load_manifest(path):
+    """Read the manifest of a layer cache.
+
+    ``path`` is either a bundle directory holding a ``manifest.json`` and
+    the archives of the images, or a manifest file on its own. The
+    manifest maps image names to the reference they were built as::
+
+        {"images": {"base": {"ref": "kolla/centos-binary-base:8.0.0",
+                             "id": "sha256:...",
+                             "file": "images-0123456789ab.tar"}}}
+
+    Images saved together share one archive, so their common layers are
+    only stored once. ``file`` is only used in bundle directories, images
+    without it are pulled by their reference.
+    """
+    manifest_path = path
+    if os.path.isdir(path):
+        manifest_path = os.path.join(path, MANIFEST)
+    if not os.path.exists(manifest_path):
+        return {}
+    try:
+        with open(manifest_path) as f:
+            return json.load(f).get('images', {})
+    except (IOError, ValueError) as e:
+        LOG.warning('Ignoring unreadable layer cache manifest %s: %s',
+                    manifest_path, e)
+        return {}
+
+
+def _consume(stream, ref):
+    for response in stream or []:
+        if isinstance(response, dict) and 'errorDetail' in response:
+            LOG.warning('Unable to import %s into the layer cache: %s',
+                        ref, response['errorDetail']['message'])
+            return False
+    return True
+
+
+def save_images(dc, names, chunk_size=1024 * 1024):
+    """Stream one archive of several images, like ``docker save``.
+
+    docker-py only saves a single image per call, while the Docker API
+    saves any number of them in one archive holding each layer once.
+    """
+    response = dc._get(dc._url('/images/get'), params={'names': names},
+                       stream=True)
+    dc._raise_for_status(response)
+    return response.iter_content(chunk_size)
+
+
+def import_cache(dc, path, images):
+    """Seed the Docker cache with the previous build of images.
+
+    Return a dict mapping the names of the imported images to the
+    reference they can be used as build cache with.
+    """
+    entries = load_manifest(path)
+    bundle_dir = path if os.path.isdir(path) else None
+    imported = dict()
+    loaded = dict()
+    for image in images:
+        entry = entries.get(image.name)
+        if not entry or not entry.get('ref'):
+            continue
+        ref = entry['ref']
+        try:
+            if bundle_dir and entry.get('file'):
+                # NOTE: Archives hold several images, each is loaded once.
+                if entry['file'] not in loaded:
+                    archive = os.path.join(bundle_dir, entry['file'])
+                    with open(archive, 'rb') as f:
+                        loaded[entry['file']] = _consume(dc.load_image(f),
+                                                         archive)
+                ok = loaded[entry['file']]
+            else:
+                repository, tag = ref.rsplit(':', 1)
+                ok = _consume(dc.pull(repository, tag=tag,
+                                      stream=True, decode=True), ref)
+        except Exception as e:
+            LOG.warning('Unable to import %s into the layer cache: %s',
+                        ref, e)
+            continue
+        if ok:
+            imported[image.name] = ref
+    LOG.info('Imported %d of %d images into the layer cache from %s',
+             len(imported), len(images), path)
+    return imported
+
+
+def export_cache(dc, path, images):
+    """Save the given images and their manifest into a bundle directory.
+
+    Images whose ID changed since the bundle was written are saved
+    together in a single archive, unchanged images are not saved again.
+    Archives no image refers to any more are removed.
+    """
+    if not os.path.exists(path):
+        os.makedirs(path)
+    entries = load_manifest(path)
+    changed = dict()
+    for image in images:
+        try:
+            image_id = dc.inspect_image(image.canonical_name)['Id']
+        except Exception as e:
+            LOG.warning('Unable to export %s to the layer cache: %s',
+                        image.canonical_name, e)
+            continue
+        entry = entries.get(image.name) or {}
+        if (entry.get('id') == image_id and entry.get('file') and
+                os.path.exists(os.path.join(path, entry['file']))):
+            entry['ref'] = image.canonical_name
+            continue
+        changed[image.name] = {'ref': image.canonical_name,
+                               'id': image_id}
+
+    if changed:
+        ids = sorted(entry['id'] for entry in changed.values())
+        file_name = 'images-%s.tar' % hashlib.sha256(
+            '\0'.join(ids).encode('utf-8')).hexdigest()[:12]
+        archive = os.path.join(path, file_name)
+        tmp_archive = archive + '.tmp'
+        with open(tmp_archive, 'wb') as f:
+            for chunk in save_images(dc, sorted(
+                    entry['ref'] for entry in changed.values())):
+                f.write(chunk)
+        os.rename(tmp_archive, archive)
+        for name, entry in changed.items():
+            entry['file'] = file_name
+            entries[name] = entry
+
+    tmp_manifest = os.path.join(path, MANIFEST + '.tmp')
+    with open(tmp_manifest, 'w') as f:
+        json.dump({'images': entries}, f, indent=2, sort_keys=True)
+    os.rename(tmp_manifest, os.path.join(path, MANIFEST))
+
+    used = set(entry.get('file') for entry in entries.values())
+    for archive in glob.glob(os.path.join(path, '*.tar')):
+        if os.path.basename(archive) not in used:
+            os.remove(archive)
+    LOG.info('Exported %d images to the layer cache in %s (%d unchanged)',
+             len(changed), path, len(images) - len(changed))
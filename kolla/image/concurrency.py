@@ -0,0 +1,202 @@
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import collections
+import multiprocessing
+import os
+import threading
+import time
+
+from kolla.common import utils
+
+
+LOG = utils.make_a_logger()
+
+# Seconds in between two adjustments of the number of build threads.
+INTERVAL = 10
+
+# Load average per CPU above which builds are throttled, and below which
+# more builds may be started.
+LOAD_HIGH = 1.5
+LOAD_LOW = 1.0
+
+# Docker API round-trip in seconds above which builds are throttled.
+LATENCY_HIGH = 1.0
+
+# Fraction of free disk in the Docker root below which builds are
+# throttled.
+DISK_LOW = 0.1
+
+# Throughput is the number of builds finished over the last
+# THROUGHPUT_WINDOW intervals. A drop below THROUGHPUT_DROP times the
+# previous throughput undoes the previous increase, when the previous
+# throughput counts at least THROUGHPUT_MIN builds.
+THROUGHPUT_WINDOW = 6
+THROUGHPUT_DROP = 0.7
+THROUGHPUT_MIN = 3
+
+
+class ResizableSemaphore(object):
+    """Semaphore whose number of slots can change while it is in use.
+
+    Shrinking never interrupts holders, new acquirers wait until enough
+    slots were released.
+    """
+
+    def __init__(self, limit):
+        self.limit = limit
+        self.in_use = 0
+        self.waiting = 0
+        self.completed = 0
+        self._condition = threading.Condition()
+
+    def acquire(self):
+        with self._condition:
+            self.waiting += 1
+            try:
+                while self.in_use >= self.limit:
+                    self._condition.wait()
+            finally:
+                self.waiting -= 1
+            self.in_use += 1
+
+    def release(self):
+        with self._condition:
+            self.in_use -= 1
+            self.completed += 1
+            self._condition.notify()
+
+    def resize(self, limit):
+        with self._condition:
+            self.limit = limit
+            self._condition.notify_all()
+
+    def __enter__(self):
+        self.acquire()
+        return self
+
+    def __exit__(self, *args):
+        self.release()
+
+
+def is_local(docker_host):
+    """Whether a Docker host runs on this machine."""
+    if docker_host is None:
+        docker_host = os.environ.get('DOCKER_HOST', '')
+    return (not docker_host or docker_host.startswith('unix://') or
+            '://localhost' in docker_host or '://127.0.0.1' in docker_host)
+
+
+class ConcurrencyController(threading.Thread):
+    """Adapts the number of concurrent builds of every Docker host.
+
+    Every INTERVAL seconds the controller measures the Docker API latency
+    and the free disk of the Docker root of each host, the load average of
+    this machine for local hosts, and the number of builds finished over
+    the last intervals. A host is given one more build slot while builds
+    wait for one and the host is healthy, and one less when it is
+    overloaded or when the throughput dropped after the last increase.
+    Limits start halfway and stay in between --min-threads and --threads.
+
+    :param slots: dict mapping Docker hosts to their ResizableSemaphore
+    :param client_pool: callable returning the client pool of a host
+    """
+
+    def __init__(self, conf, slots, client_pool):
+        super(ConcurrencyController, self).__init__(
+            name='ConcurrencyController')
+        self.daemon = True
+        self.conf = conf
+        self.slots = slots
+        self.client_pool = client_pool
+        self.min_threads = min(conf.min_threads, conf.threads)
+        self.max_threads = conf.threads
+        self._stop_event = threading.Event()
+        self._completed = dict((host, 0) for host in slots)
+        self._window = dict(
+            (host, collections.deque(maxlen=THROUGHPUT_WINDOW))
+            for host in slots)
+        self._throughput = dict((host, 0) for host in slots)
+        self._grown = dict((host, False) for host in slots)
+        self._docker_root = dict()
+        try:
+            self._cpus = multiprocessing.cpu_count()
+        except NotImplementedError:
+            self._cpus = 1
+        for semaphore in slots.values():
+            semaphore.resize(max(self.min_threads, self.max_threads // 2))
+
+    def stop(self):
+        self._stop_event.set()
+
+    def run(self):
+        while not self._stop_event.wait(INTERVAL):
+            for host, semaphore in self.slots.items():
+                try:
+                    self.adjust(host, semaphore)
+                except Exception:
+                    LOG.exception('Unable to adjust the build threads of %s',
+                                  host or 'the Docker host')
+
+    def measure(self, host):
+        """Return the API latency and free disk ratio of a Docker host."""
+        pool = self.client_pool(host)
+        client = pool.acquire()
+        try:
+            start = time.time()
+            client.ping()
+            latency = time.time() - start
+            if host not in self._docker_root:
+                self._docker_root[host] = client.info().get('DockerRootDir')
+        finally:
+            pool.release(client)
+        free = None
+        root = self._docker_root.get(host)
+        if root and is_local(host) and os.path.isdir(root):
+            st = os.statvfs(root)
+            if st.f_blocks:
+                free = float(st.f_bavail) / st.f_blocks
+        return latency, free
+
+    def adjust(self, host, semaphore):
+        latency, free = self.measure(host)
+        load = None
+        if is_local(host) and hasattr(os, 'getloadavg'):
+            load = os.getloadavg()[0] / self._cpus
+        completed = semaphore.completed
+        self._window[host].append(completed - self._completed[host])
+        self._completed[host] = completed
+        throughput = sum(self._window[host])
+        previous = self._throughput[host]
+        self._throughput[host] = throughput
+
+        limit = semaphore.limit
+        reason = None
+        if load is not None and load > LOAD_HIGH:
+            new_limit, reason = limit - 1, 'load %.2f per CPU' % load
+        elif latency > LATENCY_HIGH:
+            new_limit, reason = limit - 1, 'API latency %.2fs' % latency
+        elif free is not None and free < DISK_LOW:
+            new_limit, reason = limit - 1, '%.0f%% disk free' % (free * 100)
+        elif (self._grown[host] and previous >= THROUGHPUT_MIN and
+                throughput < previous * THROUGHPUT_DROP):
+            new_limit, reason = limit - 1, 'throughput dropped'
+        elif semaphore.waiting and (load is None or load < LOAD_LOW):
+            new_limit, reason = limit + 1, 'builds are waiting'
+        else:
+            new_limit = limit
+        new_limit = max(self.min_threads, min(self.max_threads, new_limit))
+        self._grown[host] = new_limit > limit
+        if new_limit != limit:
+            LOG.info('Changing concurrent builds on %s from %d to %d: %s',
+                     host or 'the Docker host', limit, new_limit, reason)
+            semaphore.resize(new_limit)
@@ -0,0 +1,109 @@
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import datetime
+import json
+import os
+
+from kolla.common import utils
+
+
+LOG = utils.make_a_logger()
+
+# Number of runs kept in the history file. Older runs are dropped.
+MAX_RUNS = 30
+
+# Build phases recorded for every image.
+PHASES = ('fetch', 'archive', 'context', 'build', 'squash', 'push')
+
+
+class BuildHistory(object):
+    """Per-image build durations recorded across kolla-build runs.
+
+    The history is a JSON document holding the most recent runs::
+
+        {"runs": [{"started": "...", "finished": "...",
+                   "images": {"base": {"durations": {"build": 42.1},
+                                       "cache_hits": 3,
+                                       "steps": 12}}}]}
+
+    Only successfully built images are recorded so that failures do not
+    skew the averages.
+    """
+
+    def __init__(self, path, max_runs=MAX_RUNS):
+        self.path = path
+        self.max_runs = max_runs
+        self.runs = []
+        self.started = datetime.datetime.now()
+
+    def load(self):
+        if not os.path.exists(self.path):
+            return
+        try:
+            with open(self.path) as f:
+                self.runs = json.load(f).get('runs', [])
+        except (IOError, ValueError) as e:
+            LOG.warning('Ignoring unreadable build history %s: %s',
+                        self.path, e)
+            self.runs = []
+
+    def save(self):
+        tmp_path = self.path + '.tmp'
+        with open(tmp_path, 'w') as f:
+            json.dump({'runs': self.runs[-self.max_runs:]}, f,
+                      indent=2, sort_keys=True)
+        os.rename(tmp_path, self.path)
+        LOG.debug('Saved build history to %s', self.path)
+
+    def add_run(self, images):
+        """Append the timings of the images built in the current run."""
+        run = {
+            'started': self.started.isoformat(),
+            'finished': datetime.datetime.now().isoformat(),
+            'images': {},
+        }
+        for image in images:
+            if not image.timings:
+                continue
+            run['images'][image.name] = {
+                'durations': dict(image.timings),
+                'cache_hits': image.cache_hits,
+                'steps': image.build_steps,
+            }
+        self.runs.append(run)
+
+    def durations(self, image_name, phase='build'):
+        """Recorded durations of a phase for an image, oldest first."""
+        durations = []
+        for run in self.runs:
+            entry = run['images'].get(image_name)
+            if entry and phase in entry['durations']:
+                durations.append(entry['durations'][phase])
+        return durations
+
+    def average(self, image_name, phase='build'):
+        durations = self.durations(image_name, phase)
+        if not durations:
+            return None
+        return sum(durations) / len(durations)
+
+    def average_all(self, phase='build'):
+        """Average duration of a phase over every recorded image."""
+        durations = []
+        for run in self.runs:
+            for entry in run['images'].values():
+                if phase in entry['durations']:
+                    durations.append(entry['durations'][phase])
+        if not durations:
+            return None
+        return sum(durations) / len(durations)
@@ -0,0 +1,196 @@
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import os
+import threading
+
+from six.moves import BaseHTTPServer
+
+from kolla.common import utils
+
+
+LOG = utils.make_a_logger()
+
+# Seconds in between two writes of the metrics file.
+WRITE_INTERVAL = 10
+
+
+def _labels(**labels):
+    if not labels:
+        return ''
+    return '{%s}' % ','.join(
+        '%s="%s"' % (key, str(value).replace('\\', '\\\\')
+                     .replace('"', '\\"').replace('\n', '\\n'))
+        for key, value in sorted(labels.items()))
+
+
+class BuildMetrics(object):
+    """Collects the state of a running build in Prometheus text format.
+
+    :param images: the images of the build
+    :param queues: dict mapping queue names to task queues
+    :param workers: the WorkerThreads of the build
+    :param fetcher: the SourceFetcher of the build, if any
+    """
+
+    def __init__(self, images, queues, workers, fetcher=None):
+        self.images = images
+        self.queues = queues
+        self.workers = workers
+        self.fetcher = fetcher
+
+    def render(self):
+        lines = []
+
+        def metric(name, kind, help_text, samples):
+            lines.append('# HELP %s %s' % (name, help_text))
+            lines.append('# TYPE %s %s' % (name, kind))
+            for labels, value in samples:
+                lines.append('%s%s %s' % (name, _labels(**labels), value))
+
+        queue_names = dict()
+        for name, queue in self.queues.items():
+            queue_names[id(queue)] = name
+            # NOTE: The build queue is split by Docker host.
+            for host_queue in getattr(queue, 'queues', {}).values():
+                queue_names[id(host_queue)] = name
+        metric('kolla_build_queue_depth', 'gauge',
+               'Tasks waiting in a queue.',
+               [({'queue': name}, queue.qsize())
+                for name, queue in sorted(self.queues.items())])
+        metric('kolla_build_queue_unfinished_tasks', 'gauge',
+               'Tasks queued or running.',
+               [({'queue': name}, queue.unfinished_tasks)
+                for name, queue in sorted(self.queues.items())])
+
+        workers = dict()
+        retries = dict()
+        for worker in self.workers:
+            name = queue_names.get(id(worker.queue), 'unknown')
+            busy, idle = workers.get(name, (0, 0))
+            if worker.busy:
+                busy += 1
+            else:
+                idle += 1
+            workers[name] = (busy, idle)
+            retries[name] = retries.get(name, 0) + worker.retries
+        samples = []
+        for name, (busy, idle) in sorted(workers.items()):
+            samples.append(({'queue': name, 'state': 'busy'}, busy))
+            samples.append(({'queue': name, 'state': 'idle'}, idle))
+        metric('kolla_build_workers', 'gauge',
+               'Worker threads by queue and state.', samples)
+        metric('kolla_build_task_retries_total', 'counter',
+               'Task attempts retried after a failure.',
+               [({'queue': name}, count)
+                for name, count in sorted(retries.items())])
+
+        statuses = dict()
+        for image in self.images:
+            statuses[image.status] = statuses.get(image.status, 0) + 1
+        metric('kolla_build_images', 'gauge', 'Images by status.',
+               [({'status': status}, count)
+                for status, count in sorted(statuses.items())])
+
+        metric('kolla_build_image_phase_seconds', 'gauge',
+               'Duration of the build phases of images.',
+               [({'image': image.name, 'phase': phase}, '%.3f' % duration)
+                for image in self.images
+                for phase, duration in sorted(image.timings.items())])
+
+        metric('kolla_build_context_bytes_total', 'counter',
+               'Bytes of build contexts sent to Docker.',
+               [({}, sum(image.context_size for image in self.images))])
+        metric('kolla_build_pushed_bytes_total', 'counter',
+               'Bytes of layers uploaded to registries.',
+               [({}, sum(image.push_stats.get('bytes_pushed', 0)
+                         for image in self.images))])
+        if self.fetcher is not None:
+            metric('kolla_build_downloaded_bytes_total', 'counter',
+                   'Bytes downloaded for url sources.',
+                   [({}, self.fetcher.downloaded_bytes)])
+        return '\n'.join(lines) + '\n'
+
+
+class MetricsExporter(object):
+    """Exposes build metrics in a file, over HTTP, or both.
+
+    The file is meant for the textfile collector of the node exporter, it
+    is rewritten atomically every WRITE_INTERVAL seconds and once more
+    when the exporter is stopped.
+    """
+
+    def __init__(self, metrics, path=None, port=None):
+        self.metrics = metrics
+        self.path = path
+        self.port = port
+        self._stop = threading.Event()
+        self._writer = None
+        self._server = None
+
+    def start(self):
+        if self.path:
+            self._writer = threading.Thread(target=self._write_loop,
+                                            name='MetricsWriter')
+            self._writer.daemon = True
+            self._writer.start()
+        if self.port:
+            metrics = self.metrics
+
+            class Handler(BaseHTTPServer.BaseHTTPRequestHandler):
+                def do_GET(self):
+                    if self.path != '/metrics':
+                        self.send_error(404)
+                        return
+                    body = metrics.render().encode('utf-8')
+                    self.send_response(200)
+                    self.send_header('Content-Type',
+                                     'text/plain; version=0.0.4')
+                    self.send_header('Content-Length', str(len(body)))
+                    self.end_headers()
+                    self.wfile.write(body)
+
+                def log_message(self, *args):
+                    pass
+
+            self._server = BaseHTTPServer.HTTPServer(('', self.port),
+                                                     Handler)
+            thread = threading.Thread(target=self._server.serve_forever,
+                                      name='MetricsServer')
+            thread.daemon = True
+            thread.start()
+            LOG.info('Serving build metrics on port %d', self.port)
+
+    def stop(self):
+        self._stop.set()
+        if self._writer is not None:
+            self._writer.join()
+        if self._server is not None:
+            self._server.shutdown()
+            self._server.server_close()
+
+    def _write_loop(self):
+        while True:
+            stopped = self._stop.wait(WRITE_INTERVAL)
+            self.write()
+            if stopped or self._stop.is_set():
+                return
+
+    def write(self):
+        tmp_path = self.path + '.tmp'
+        try:
+            with open(tmp_path, 'w') as f:
+                f.write(self.metrics.render())
+            os.rename(tmp_path, self.path)
+        except (IOError, OSError) as e:
+            LOG.warning('Unable to write build metrics to %s: %s',
+                        self.path, e)
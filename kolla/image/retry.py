@@ -0,0 +1,151 @@
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import random
+import re
+import threading
+
+import docker
+from requests import exceptions as requests_exc
+
+from kolla.common import utils
+
+
+LOG = utils.make_a_logger()
+
+# Failure classes. Transient failures are worth retrying after a while,
+# deterministic ones fail the same way every time. Failures that cannot be
+# classified are retried like transient ones.
+TRANSIENT = 'transient'
+DETERMINISTIC = 'deterministic'
+UNKNOWN = 'unknown'
+
+# Upper bound in seconds of the delay in between two attempts.
+MAX_BACKOFF = 60
+
+# Number of the most recent log lines of an image searched for the cause
+# of a failure.
+LOG_LINES = 50
+
+# HTTP status codes of the Docker API or registries worth retrying.
+TRANSIENT_STATUS_CODES = (408, 425, 429, 500, 502, 503, 504)
+
+TRANSIENT_PATTERNS = re.compile('|'.join([
+    r'timed? ?out',
+    r'connection (reset|refused|aborted)',
+    r'temporary failure',
+    r'could not resolve',
+    r'name or service not known',
+    r'network is unreachable',
+    r'no route to host',
+    r'unexpected eof',
+    r'tls handshake',
+    r'too many requests',
+    r'service unavailable',
+    r'bad gateway',
+    r'gateway time-?out',
+    r'failed to connect',
+    r'cannot retrieve repository metadata',
+    r'cannot find a valid baseurl',
+    r'curl(#| error \()\d+',
+    r'download is incomplete',
+]), re.IGNORECASE)
+
+DETERMINISTIC_PATTERNS = re.compile('|'.join([
+    r'dockerfile parse error',
+    r'unknown instruction',
+    r'(copy|add) failed',
+    r'no such file or directory',
+    r'returned a non-zero code',
+    r'no space left on device',
+    r'checksum mismatch',
+    r'no package .* available',
+    r'unable to find a match',
+    r'manifest (for .* )?(not found|unknown)',
+    r'unauthorized',
+    r'denied',
+]), re.IGNORECASE)
+
+
+def classify_messages(messages):
+    """Classify a failure from error messages and recent log lines.
+
+    Transient patterns win, a command failing because of the network also
+    reports a non-zero code.
+    """
+    deterministic = False
+    for message in messages:
+        if TRANSIENT_PATTERNS.search(message):
+            return TRANSIENT
+        if DETERMINISTIC_PATTERNS.search(message):
+            deterministic = True
+    return DETERMINISTIC if deterministic else UNKNOWN
+
+
+def classify_log(logger, messages=(), since=None):
+    """Classify a failure from messages and the last log lines of an image.
+
+    :param since: log position the failed attempt started at, earlier
+                  lines belong to previous attempts and are left out
+    """
+    return classify_messages(list(messages) +
+                             utils.get_log_buffer(logger, since)[-LOG_LINES:])
+
+
+def classify_exception(exc):
+    """Classify a failure from the exception that caused it."""
+    if isinstance(exc, (requests_exc.ConnectionError, requests_exc.Timeout)):
+        return TRANSIENT
+    if isinstance(exc, docker.errors.APIError):
+        status_code = getattr(exc, 'status_code', None)
+        if status_code in TRANSIENT_STATUS_CODES:
+            return TRANSIENT
+        if status_code is not None and 400 <= status_code < 500:
+            return DETERMINISTIC
+        return classify_messages([str(exc)])
+    if isinstance(exc, (EnvironmentError, docker.errors.DockerException)):
+        return classify_messages([str(exc)])
+    return UNKNOWN
+
+
+class RetryPolicy(object):
+    """Decides whether and when failed tasks are tried again.
+
+    Deterministic failures are not retried. Other failures are retried up
+    to --retries times per task, after an exponential backoff with full
+    jitter, as long as the --retry-budget shared by the whole run is not
+    exhausted.
+    """
+
+    def __init__(self, conf):
+        self.conf = conf
+        self.budget = conf.retry_budget
+        self.used = 0
+        self._lock = threading.Lock()
+
+    def should_retry(self, task, failure):
+        if failure == DETERMINISTIC:
+            LOG.info('Not retrying %s, it failed deterministically',
+                     task.name)
+            return False
+        with self._lock:
+            if self.budget is not None and self.used >= self.budget:
+                LOG.info('Not retrying %s, the retry budget of %d is'
+                         ' exhausted', task.name, self.budget)
+                return False
+            self.used += 1
+        return True
+
+    def backoff(self, attempt):
+        """Return the delay in seconds before the given retry attempt."""
+        delay = min(MAX_BACKOFF, self.conf.retry_backoff * 2 ** (attempt - 1))
+        return random.uniform(0, delay)  # nosec
@@ -0,0 +1,431 @@
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import contextlib
+import errno
+import glob
+import hashlib
+import json
+import os
+import shutil
+import threading
+
+import git
+import requests
+from requests import exceptions as requests_exc
+import six
+
+from kolla.common import utils
+
+
+LOG = utils.make_a_logger()
+
+# Size of the chunks downloaded archives are streamed to disk in.
+DOWNLOAD_CHUNK_SIZE = 1024 * 1024
+
+# Left out of git source archives, the object store and index of a fresh
+# clone differ from one clone to the next.
+GIT_METADATA = ('.git',)
+
+
+def get_sources(image, install_type):
+    """List the sources, plugins and additions an image is built from."""
+    sources = list()
+    if image.source and 'source' in image.source:
+        sources.append(image.source)
+    if install_type == 'source':
+        sources.extend(image.plugins)
+        sources.extend(image.additions)
+    return sources
+
+
+class SourceFetcher(object):
+    """Fetches image sources on a dedicated pool of threads.
+
+    Prefetching starts as soon as the list of images to build is known, so
+    downloads and clones overlap with the Docker builds of parent images.
+    Build tasks then pick the archives up with :meth:`get_archive`.
+    """
+
+    def __init__(self, conf):
+        self.conf = conf
+        self._queue = six.moves.queue.Queue()
+        # Maps (image name, source name) to the fetched archive path, or
+        # None when fetching failed.
+        self._archives = dict()
+        # Set once all sources of an image were processed.
+        self._fetched = dict()
+
+        self.cache_dir = conf.source_cache_dir
+        if not self.cache_dir and conf.work_dir:
+            self.cache_dir = os.path.join(conf.work_dir, 'source-cache')
+        # Serializes access to each cached source, several images may be
+        # built from the same repository.
+        self._cache_locks = dict()
+        self._cache_locks_lock = threading.Lock()
+        self._updated_mirrors = set()
+        # Bytes received from url sources during this run.
+        self.downloaded_bytes = 0
+        self._stats_lock = threading.Lock()
+
+    def start(self, images):
+        """Start fetching the sources of the given images in order."""
+        images = [image for image in images
+                  if get_sources(image, self.conf.install_type)]
+        for image in images:
+            self._fetched[image.name] = threading.Event()
+            self._queue.put(image)
+        for x in six.moves.range(min(self.conf.fetch_threads, len(images))):
+            thread = threading.Thread(target=self._run,
+                                      name='SourceFetcher-%d' % x)
+            thread.daemon = True
+            thread.start()
+        LOG.debug('Prefetching sources of %d images', len(images))
+
+    def _run(self):
+        while True:
+            try:
+                image = self._queue.get_nowait()
+            except six.moves.queue.Empty:
+                return
+            try:
+                with image.timed('fetch'):
+                    for source in get_sources(image, self.conf.install_type):
+                        archive = self.process_source(image, source)
+                        self._archives[(image.name, source['name'])] = archive
+            except Exception:
+                image.logger.exception('Unhandled error when fetching'
+                                       ' sources')
+            finally:
+                self._fetched[image.name].set()
+
+    def get_archive(self, image, source):
+        """Return the path of the archive of a source, None on failure.
+
+        Waits for the prefetch of the image to finish. Sources that were
+        not prefetched, or failed to be, are fetched right away so that
+        build retries fetch them again.
+        """
+        fetched = self._fetched.get(image.name)
+        if fetched is not None:
+            fetched.wait()
+            archive = self._archives.pop((image.name, source['name']), None)
+            if archive is not None:
+                return archive
+        return self.process_source(image, source)
+
+    def process_source(self, image, source):
+        logger = image.logger
+        dest_archive = os.path.join(image.path, source['name'] + '-archive')
+
+        if source.get('type') == 'url':
+            logger.debug("Getting archive from %s", source['source'])
+            try:
+                if self.cache_dir:
+                    downloaded = self.download_cached(logger, source,
+                                                      dest_archive)
+                else:
+                    downloaded = self.download(logger, source, dest_archive)
+            except requests_exc.Timeout:
+                logger.exception(
+                    'Request timed out while getting archive from %s',
+                    source['source'])
+                return
+            except requests_exc.RequestException:
+                logger.exception('Failed to get archive from %s',
+                                 source['source'])
+                return
+            if not downloaded:
+                return
+
+        elif source.get('type') == 'git' and self.cache_dir:
+            if not self.fetch_git_cached(image, source, dest_archive):
+                return
+
+        elif source.get('type') == 'git':
+            clone_dir = '{}-{}'.format(dest_archive,
+                                       source['reference'].replace('/', '-'))
+            if os.path.exists(clone_dir):
+                logger.info("Clone dir %s exists. Removing it.", clone_dir)
+                shutil.rmtree(clone_dir)
+
+            try:
+                logger.debug("Cloning from %s", source['source'])
+                git.Git().clone(source['source'], clone_dir)
+                git.Git(clone_dir).checkout(source['reference'])
+                reference_sha = git.Git(clone_dir).rev_parse('HEAD')
+                logger.debug("Git checkout by reference %s (%s)",
+                             source['reference'], reference_sha)
+            except Exception as e:
+                logger.error("Failed to get source from git")
+                logger.error("Error: %s", e)
+                # clean-up clone folder to retry
+                shutil.rmtree(clone_dir, ignore_errors=True)
+                return
+
+            with utils.open_tar(dest_archive) as tar:
+                utils.add_to_tar(tar, clone_dir, os.path.basename(clone_dir),
+                                 exclude=GIT_METADATA)
+
+        elif source.get('type') == 'local':
+            logger.debug("Getting local archive from %s", source['source'])
+            if os.path.isdir(source['source']):
+                with utils.open_tar(dest_archive) as tar:
+                    utils.add_to_tar(tar, source['source'],
+                                     os.path.basename(source['source']))
+            else:
+                shutil.copyfile(source['source'], dest_archive)
+
+        else:
+            logger.error("Wrong source type '%s'", source.get('type'))
+            return
+
+        # Set time on destination archive to epoch 0
+        os.utime(dest_archive, (0, 0))
+
+        return dest_archive
+
+    def cache_lock(self, path):
+        with self._cache_locks_lock:
+            return self._cache_locks.setdefault(path, threading.Lock())
+
+    def update_git_mirror(self, logger, url):
+        """Create or update the bare mirror of a repository.
+
+        Mirrors are kept in the source cache directory, keyed by URL, and
+        updated with an incremental fetch once per run.
+        """
+        key = hashlib.sha1(url.encode('utf-8')).hexdigest()
+        mirror = os.path.join(self.cache_dir, 'git', key + '.git')
+        with self.cache_lock(mirror):
+            if mirror in self._updated_mirrors:
+                return mirror
+            if os.path.isdir(mirror):
+                logger.debug("Updating git mirror %s of %s", mirror, url)
+                git.Git(mirror).fetch('--prune', 'origin')
+            else:
+                logger.debug("Creating git mirror %s of %s", mirror, url)
+                git.Git().clone('--mirror', url, mirror)
+            self._updated_mirrors.add(mirror)
+        return mirror
+
+    def fetch_git_cached(self, image, source, dest_archive):
+        """Archive a git source checked out from its cached mirror.
+
+        The archive is kept next to the mirror and reused as long as the
+        reference resolves to the same commit.
+
+        :return: True on success
+        """
+        logger = image.logger
+        clone_dir = '{}-{}'.format(dest_archive,
+                                   source['reference'].replace('/', '-'))
+        try:
+            mirror = self.update_git_mirror(logger, source['source'])
+            reference_sha = git.Git(mirror).rev_parse(
+                '--verify', source['reference'] + '^{commit}')
+        except Exception as e:
+            logger.error("Failed to update the git mirror of %s",
+                         source['source'])
+            logger.error("Error: %s", e)
+            return False
+        logger.debug("Git reference %s resolved to %s",
+                     source['reference'], reference_sha)
+
+        cached_archive = '{}-{}-{}.tar'.format(
+            mirror[:-len('.git')], os.path.basename(clone_dir),
+            reference_sha)
+        with self.cache_lock(cached_archive):
+            if os.path.exists(cached_archive):
+                logger.info("Reusing archive of %s at %s",
+                            source['reference'], reference_sha)
+                shutil.copyfile(cached_archive, dest_archive)
+                return True
+
+            if os.path.exists(clone_dir):
+                shutil.rmtree(clone_dir)
+            try:
+                # NOTE: A local clone hard links the objects of the mirror,
+                #       the result does not depend on the cache directory.
+                git.Git().clone(mirror, clone_dir)
+                git.Git(clone_dir).checkout(source['reference'])
+                git.Git(clone_dir).remote('set-url', 'origin',
+                                          source['source'])
+            except Exception as e:
+                logger.error("Failed to get source from git")
+                logger.error("Error: %s", e)
+                shutil.rmtree(clone_dir, ignore_errors=True)
+                return False
+
+            with utils.open_tar(dest_archive) as tar:
+                utils.add_to_tar(tar, clone_dir, os.path.basename(clone_dir),
+                                 exclude=GIT_METADATA)
+            shutil.rmtree(clone_dir)
+
+            # Only keep the archive of the latest commit around.
+            for old_archive in glob.glob('{}-{}-*.tar'.format(
+                    mirror[:-len('.git')], os.path.basename(clone_dir))):
+                os.remove(old_archive)
+            shutil.copyfile(dest_archive, cached_archive + '.tmp')
+            os.rename(cached_archive + '.tmp', cached_archive)
+        return True
+
+    def write_response(self, logger, response, path, sha, append=False):
+        """Stream the body of a response to a file in chunks.
+
+        :param sha: hash object updated with the written data
+        :return: True if the whole body was received
+        """
+        written = 0
+        with open(path, 'ab' if append else 'wb') as f:
+            for chunk in response.iter_content(DOWNLOAD_CHUNK_SIZE):
+                f.write(chunk)
+                sha.update(chunk)
+                written += len(chunk)
+        with self._stats_lock:
+            self.downloaded_bytes += written
+        expected = response.headers.get('Content-Length')
+        if (expected is not None and
+                'Content-Encoding' not in response.headers and
+                written != int(expected)):
+            logger.error('Download of %s is incomplete: got %d of %s bytes',
+                         response.url, written, expected)
+            return False
+        return True
+
+    def verify_checksum(self, logger, source, digest):
+        expected = source.get('sha256')
+        if expected and expected.lower() != digest:
+            logger.error('Checksum mismatch for %s: expected sha256 %s,'
+                         ' got %s', source['source'], expected, digest)
+            return False
+        return True
+
+    def download(self, logger, source, dest_archive):
+        """Download a url source straight to its archive.
+
+        :return: True on success
+        """
+        response = requests.get(source['source'], timeout=self.conf.timeout,
+                                stream=True)
+        with contextlib.closing(response):
+            if response.status_code != 200:
+                logger.error('Failed to download archive: status_code %s',
+                             response.status_code)
+                return False
+            sha = hashlib.sha256()
+            if not self.write_response(logger, response, dest_archive, sha):
+                return False
+        return self.verify_checksum(logger, source, sha.hexdigest())
+
+    def download_cached(self, logger, source, dest_archive):
+        """Download a url source through the download cache.
+
+        Cached downloads are keyed by URL and revalidated with conditional
+        requests using the stored ETag and Last-Modified headers. Partial
+        downloads left by an interrupted run are resumed with a range
+        request.
+
+        :return: True on success
+        """
+        url = source['source']
+        key = hashlib.sha1(url.encode('utf-8')).hexdigest()
+        cached = os.path.join(self.cache_dir, 'downloads', key)
+        with self.cache_lock(cached):
+            if not self.update_download(logger, source, cached):
+                return False
+            if os.path.exists(dest_archive):
+                os.remove(dest_archive)
+            try:
+                os.link(cached, dest_archive)
+            except OSError:
+                shutil.copyfile(cached, dest_archive)
+        return True
+
+    def update_download(self, logger, source, cached):
+        url = source['source']
+        meta_path = cached + '.json'
+        partial = cached + '.part'
+        try:
+            with open(meta_path) as f:
+                meta = json.load(f)
+        except (IOError, ValueError):
+            meta = dict()
+        if meta.get('url') != url:
+            meta = {'url': url}
+
+        headers = dict()
+        validator = meta.get('etag') or meta.get('last_modified')
+        offset = 0
+        if os.path.exists(cached) and 'sha256' in meta:
+            if meta.get('etag'):
+                headers['If-None-Match'] = meta['etag']
+            if meta.get('last_modified'):
+                headers['If-Modified-Since'] = meta['last_modified']
+        elif os.path.exists(partial) and validator:
+            offset = os.path.getsize(partial)
+            headers['Range'] = 'bytes=%d-' % offset
+            headers['If-Range'] = validator
+
+        response = requests.get(url, headers=headers, stream=True,
+                                timeout=self.conf.timeout)
+        with contextlib.closing(response):
+            if response.status_code == 304:
+                logger.info('Archive %s is unchanged, using cached copy',
+                            url)
+                return self.verify_checksum(logger, source, meta['sha256'])
+            if response.status_code == 206 and offset:
+                logger.info('Resuming download of %s at %d bytes',
+                            url, offset)
+            elif response.status_code == 200:
+                offset = 0
+            else:
+                logger.error('Failed to download archive: status_code %s',
+                             response.status_code)
+                return False
+
+            meta = {
+                'url': url,
+                'etag': response.headers.get('ETag'),
+                'last_modified': response.headers.get('Last-Modified'),
+            }
+            try:
+                os.makedirs(os.path.dirname(cached))
+            except OSError as e:
+                if e.errno != errno.EEXIST:
+                    raise
+            # NOTE: Store the validators first, they are needed to resume
+            #       the partial download.
+            self.write_meta(meta_path, meta)
+            sha = hashlib.sha256()
+            if offset:
+                with open(partial, 'rb') as f:
+                    for chunk in iter(lambda: f.read(DOWNLOAD_CHUNK_SIZE),
+                                      b''):
+                        sha.update(chunk)
+            if not self.write_response(logger, response, partial, sha,
+                                       append=bool(offset)):
+                return False
+
+        meta['sha256'] = sha.hexdigest()
+        if not self.verify_checksum(logger, source, meta['sha256']):
+            os.remove(partial)
+            return False
+        os.rename(partial, cached)
+        self.write_meta(meta_path, meta)
+        return True
+
+    @staticmethod
+    def write_meta(path, meta):
+        with open(path + '.tmp', 'w') as f:
+            json.dump(meta, f)
+        os.rename(path + '.tmp', path)
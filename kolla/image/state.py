@@ -0,0 +1,129 @@
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import hashlib
+import json
+import os
+import threading
+
+from kolla.common import utils
+
+
+LOG = utils.make_a_logger()
+
+# Name of the state file in the working directory.
+STATE_FILE = 'build-state.json'
+
+# Options changing what images are built from or named as. A state file
+# recorded with different values is not resumed.
+SIGNATURE_OPTS = ('base', 'base_image', 'base_tag', 'base_arch',
+                  'install_type', 'namespace', 'registry', 'tag',
+                  'build_args', 'template_override', 'squash')
+
+
+def config_signature(conf):
+    """Hash the options the images of a build depend on."""
+    values = dict()
+    for name in SIGNATURE_OPTS:
+        value = getattr(conf, name, None)
+        if isinstance(value, dict):
+            value = sorted(value.items())
+        elif isinstance(value, (list, tuple)):
+            value = list(value)
+        values[name] = value
+    return hashlib.sha256(json.dumps(values, sort_keys=True)
+                          .encode('utf-8')).hexdigest()
+
+
+class BuildState(object):
+    """Per-image state of a build, kept up to date while it runs.
+
+    The state is a JSON document rewritten every time an image is built
+    or pushed, so that it survives an interrupted run::
+
+        {"signature": "...",
+         "images": {"base": {"status": "built",
+                             "canonical_name": "kolla/centos-binary-base:t",
+                             "id": "sha256:...",
+                             "push_digest": "sha256:...",
+                             "docker_host": null}}}
+
+    ``signature`` is the config_signature of the run that wrote it, a run
+    resumes the state only when its own signature is the same.
+    """
+
+    def __init__(self, path, signature):
+        self.path = path
+        self.signature = signature
+        self.images = dict()
+        self._lock = threading.Lock()
+
+    def load(self):
+        """Read the state left by a previous run, if it can be resumed."""
+        if not os.path.exists(self.path):
+            LOG.info('No build state in %s, building everything', self.path)
+            return
+        try:
+            with open(self.path) as f:
+                state = json.load(f)
+        except (IOError, ValueError) as e:
+            LOG.warning('Ignoring unreadable build state %s: %s',
+                        self.path, e)
+            return
+        if state.get('signature') != self.signature:
+            LOG.warning('Ignoring build state %s, it was recorded with'
+                        ' different options', self.path)
+            return
+        self.images = state.get('images', {})
+
+    def save(self):
+        tmp_path = self.path + '.tmp'
+        with open(tmp_path, 'w') as f:
+            json.dump({'signature': self.signature, 'images': self.images},
+                      f, indent=2, sort_keys=True)
+        os.rename(tmp_path, self.path)
+
+    def get(self, image_name):
+        with self._lock:
+            return self.images.get(image_name)
+
+    def _update(self, image, image_id=None):
+        entry = self.images.setdefault(image.name, {})
+        entry.update(status=image.status,
+                     canonical_name=image.canonical_name,
+                     docker_host=image.docker_host)
+        if image_id is not None:
+            # NOTE: A new image was built, the previous one was pushed.
+            entry['id'] = image_id
+            entry.pop('push_digest', None)
+        if image.push_digest:
+            entry['push_digest'] = image.push_digest
+
+    def _write(self):
+        try:
+            self.save()
+        except (IOError, OSError) as e:
+            LOG.warning('Unable to write the build state to %s: %s',
+                        self.path, e)
+
+    def record(self, image, image_id=None):
+        """Record the current status of an image and write the state."""
+        with self._lock:
+            self._update(image, image_id)
+            self._write()
+
+    def record_all(self, images):
+        """Record the final status of the images of a run."""
+        with self._lock:
+            for image in images:
+                self._update(image)
+            self._write()
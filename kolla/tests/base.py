@@ -0,0 +1,50 @@
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import os
+import shutil
+import tempfile
+import unittest
+
+
+class TestCase(unittest.TestCase):
+    """Test case with helpers to create file trees in temp directories."""
+
+    def make_dir(self):
+        path = tempfile.mkdtemp(prefix='kolla-test-')
+        self.addCleanup(shutil.rmtree, path)
+        return path
+
+    def make_tree(self, files, file_mode=0o644, dir_mode=0o755, mtime=0):
+        """Create a tree from a dict mapping relative paths to contents.
+
+        Executable files are given as a (data, True) tuple. Every file and
+        directory gets the given modes and mtime, so that two trees only
+        differ by the metadata a build must ignore.
+        """
+        root = self.make_dir()
+        for rel_path, data in sorted(files.items()):
+            executable = False
+            if isinstance(data, tuple):
+                data, executable = data
+            path = os.path.join(root, rel_path)
+            if not os.path.isdir(os.path.dirname(path)):
+                os.makedirs(os.path.dirname(path))
+            with open(path, 'wb') as f:
+                f.write(data)
+            mode = file_mode | 0o111 if executable else file_mode
+            os.chmod(path, mode)
+            os.utime(path, (mtime, mtime))
+        for dir_path, dirs, names in os.walk(root):
+            os.chmod(dir_path, dir_mode)
+            os.utime(dir_path, (mtime, mtime))
+        return root
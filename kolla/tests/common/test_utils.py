@@ -0,0 +1,112 @@
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import logging
+import os
+import tarfile
+
+from kolla.common import utils
+from kolla.tests import base
+
+
+FILES = {
+    'setup.py': b'from setuptools import setup\n',
+    'bin/run': (b'#!/bin/sh\nexec true\n', True),
+    'pkg/__init__.py': b'',
+    'pkg/module.py': b'VALUE = 1\n',
+}
+
+
+class ReproducibleTarTest(base.TestCase):
+
+    def make_archive(self, root, name):
+        path = os.path.join(self.make_dir(), name)
+        with utils.open_tar(path) as tar:
+            utils.add_to_tar(tar, root, 'src')
+        return path
+
+    def read(self, path):
+        with open(path, 'rb') as f:
+            return f.read()
+
+    def test_add_to_tar_ignores_host_metadata(self):
+        first = self.make_tree(FILES, 0o644, 0o755, mtime=1000000000)
+        second = self.make_tree(FILES, 0o664, 0o775, mtime=1500000000)
+        self.assertEqual(self.read(self.make_archive(first, 'a.tar')),
+                         self.read(self.make_archive(second, 'a.tar')))
+
+    def test_add_to_tar_normalizes_members(self):
+        root = self.make_tree(FILES, 0o600, 0o700, mtime=1000000000)
+        with tarfile.open(self.make_archive(root, 'a.tar')) as tar:
+            members = tar.getmembers()
+        self.assertEqual(['src', 'src/bin', 'src/bin/run', 'src/pkg',
+                          'src/pkg/__init__.py', 'src/pkg/module.py',
+                          'src/setup.py'],
+                         [member.name for member in members])
+        modes = dict((member.name, member.mode) for member in members)
+        self.assertEqual(0o755, modes['src/pkg'])
+        self.assertEqual(0o755, modes['src/bin/run'])
+        self.assertEqual(0o644, modes['src/setup.py'])
+        for member in members:
+            self.assertEqual((0, 0, 0, '', ''),
+                             (member.mtime, member.uid, member.gid,
+                              member.uname, member.gname))
+
+    def test_merge_archives_is_reproducible(self):
+        merged = []
+        for file_mode, dir_mode, mtime in ((0o644, 0o755, 1000000000),
+                                           (0o664, 0o775, 1500000000)):
+            tree = self.make_tree(FILES, file_mode, dir_mode, mtime)
+            # NOTE: Inputs come from sources fetched with other tools, so
+            #       they keep the metadata of the host.
+            archive = os.path.join(self.make_dir(), 'source.tar.gz')
+            with tarfile.open(archive, 'w:gz') as tar:
+                tar.add(tree, arcname='project-1.0')
+            dest = os.path.join(self.make_dir(), 'plugins-archive')
+            self.assertEqual(1, utils.merge_archives([archive], dest,
+                                                     'plugins'))
+            merged.append(self.read(dest))
+        self.assertEqual(merged[0], merged[1])
+
+
+class LogBufferTest(base.TestCase):
+
+    def make_logger(self, buffer_lines):
+        logger = logging.getLogger('kolla.tests.%s' % self.id())
+        logger.propagate = False
+        handler = utils.ImageLogHandler(os.path.join(self.make_dir(), 'log'),
+                                        buffer_lines)
+        logger.addHandler(handler)
+        self.addCleanup(logger.removeHandler, handler)
+        self.addCleanup(utils.flush_logs)
+        return logger
+
+    def test_lines_since_position(self):
+        logger = self.make_logger(10)
+        logger.warning('first attempt')
+        position = utils.get_log_position(logger)
+        logger.warning('second attempt')
+        self.assertEqual(['first attempt', 'second attempt'],
+                         utils.get_log_buffer(logger))
+        self.assertEqual(['second attempt'],
+                         utils.get_log_buffer(logger, position))
+
+    def test_position_survives_full_buffer(self):
+        logger = self.make_logger(3)
+        for x in range(5):
+            logger.warning('line %d', x)
+        position = utils.get_log_position(logger)
+        self.assertEqual([], utils.get_log_buffer(logger, position))
+        logger.warning('line 5')
+        self.assertEqual(['line 5'], utils.get_log_buffer(logger, position))
+        self.assertEqual(['line 3', 'line 4', 'line 5'],
+                         utils.get_log_buffer(logger, position - 4))
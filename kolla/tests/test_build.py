@@ -0,0 +1,143 @@
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import os
+
+import git
+
+from kolla.image import build
+from kolla.image import sources
+from kolla.tests import base
+
+
+FILES = {
+    'Dockerfile': b'FROM kolla/centos-binary-base:8.0.0\nCOPY . /\n',
+    'extend_start.sh': (b'#!/bin/bash\ntrue\n', True),
+    'config/ceph.conf': b'[global]\n',
+    '.dockerignore': b'ignored\n',
+    'ignored/data': b'not sent to docker\n',
+}
+
+
+class FakeConf(object):
+    cache = True
+    keep = False
+    threads = 1
+    adaptive_threads = False
+
+    install_type = 'source'
+    fetch_threads = 1
+
+    def __init__(self, work_dir=None, source_cache_dir=None):
+        self.work_dir = work_dir
+        self.source_cache_dir = source_cache_dir
+
+
+class BuildContextTest(base.TestCase):
+
+    def make_context(self, path, work_dir=None, name='ceph-mon'):
+        image = build.Image(name, 'kolla/centos-binary-%s:8.0.0' % name,
+                            path)
+        # NOTE: Only the configuration is used to make a build context.
+        task = build.BuildTask(FakeConf(work_dir), image, None,
+                               fetcher=object(), push_scheduler=object(),
+                               squash_stage=object())
+        context, context_hash = task.make_build_context(image)
+        try:
+            return context.read(), context_hash
+        finally:
+            context.close()
+
+    def test_contexts_are_byte_identical(self):
+        first = self.make_tree(FILES, 0o644, 0o755, mtime=1000000000)
+        second = self.make_tree(FILES, 0o664, 0o775, mtime=1500000000)
+        self.assertEqual(self.make_context(first),
+                         self.make_context(second))
+
+    def test_cached_context_is_byte_identical(self):
+        path = self.make_tree(FILES)
+        work_dir = self.make_dir()
+        fresh = self.make_context(path)
+        self.assertEqual(fresh, self.make_context(path, work_dir))
+        # NOTE: The second run reuses the context kept in the work dir.
+        self.assertEqual(fresh, self.make_context(path, work_dir))
+
+    def test_cached_context_ignores_inode_and_ctime(self):
+        work_dir = self.make_dir()
+        self.make_context(self.make_tree(FILES), work_dir)
+        cached = os.path.join(work_dir, 'contexts', 'ceph-mon.tar')
+        inode = os.stat(cached).st_ino
+        # NOTE: The same files written again, as by a new working dir.
+        self.make_context(self.make_tree(FILES), work_dir)
+        self.assertEqual(inode, os.stat(cached).st_ino)
+
+    def test_cached_context_follows_content(self):
+        path = self.make_tree(FILES)
+        work_dir = self.make_dir()
+        old = self.make_context(path, work_dir)
+        conf = os.path.join(path, 'config', 'ceph.conf')
+        with open(conf, 'wb') as f:
+            f.write(b'[client]\n')
+        os.utime(conf, (0, 0))
+        new = self.make_context(path, work_dir)
+        self.assertNotEqual(old, new)
+        self.assertEqual(new, self.make_context(path))
+
+    def test_exec_bit_changes_context(self):
+        files = dict(FILES)
+        files['extend_start.sh'] = files['extend_start.sh'][0]
+        old = self.make_context(self.make_tree(FILES))
+        new = self.make_context(self.make_tree(files))
+        self.assertNotEqual(old, new)
+
+    def test_dockerignore_is_applied(self):
+        context, _ = self.make_context(self.make_tree(FILES))
+        self.assertNotIn(b'not sent to docker', context)
+        self.assertIn(b'[global]', context)
+
+
+class GitSourceArchiveTest(base.TestCase):
+
+    def setUp(self):
+        super(GitSourceArchiveTest, self).setUp()
+        self.repo = self.make_tree({'setup.py': b'setup()\n',
+                                    'ceph/__init__.py': b''})
+        repo = git.Git(self.repo)
+        repo.init()
+        repo.add('.')
+        repo.commit('-m', 'Initial commit', author='Kolla <kolla@example.com>',
+                    env={'GIT_COMMITTER_NAME': 'Kolla',
+                         'GIT_COMMITTER_EMAIL': 'kolla@example.com'})
+        self.source = {'name': 'ceph-base-source', 'type': 'git',
+                       'source': self.repo, 'reference': 'HEAD'}
+
+    def make_archive(self, source_cache_dir=None):
+        image = build.Image('ceph-base', 'kolla/centos-source-ceph-base:8.0.0',
+                            self.make_dir())
+        fetcher = sources.SourceFetcher(
+            FakeConf(source_cache_dir=source_cache_dir))
+        archive = fetcher.process_source(image, self.source)
+        self.assertIsNotNone(archive)
+        with open(archive, 'rb') as f:
+            return f.read()
+
+    def test_clones_give_byte_identical_archives(self):
+        archive = self.make_archive()
+        self.assertEqual(archive, self.make_archive())
+        self.assertIn(b'setup()', archive)
+        self.assertNotIn(b'/.git/', archive)
+
+    def test_cached_clones_give_byte_identical_archives(self):
+        self.assertEqual(self.make_archive(self.make_dir()),
+                         self.make_archive(self.make_dir()))
+        self.assertEqual(self.make_archive(),
+                         self.make_archive(self.make_dir()))